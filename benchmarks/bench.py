@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+"""
+benchmarks/bench.py - measure informant against generated feeds
+
+Usage:
+    bench.py [options]
+
+Generates RSS and Atom feeds, serves them from a local HTTP server and runs
+informant's commands against them end to end, then times each stage of
+building and showing a feed in-process. Results are printed and can be written
+as JSON so that runs can be diffed to find regressions.
+
+Options:
+    -e <entries>, --entries=<entries>   Entries in each feed [default: 100]
+    --feeds=<count>                     Number of feeds, alternating RSS and
+                                        Atom [default: 2]
+    --body-size=<bytes>                 Size of each entry's HTML body
+                                        [default: 2000]
+    --latency=<ms>                      Delay before each response
+                                        [default: 0]
+    --error-rate=<rate>                 Fraction of responses that are HTTP
+                                        500 errors [default: 0]
+    --no-etag                           Don't send ETags or answer conditional
+                                        requests with 304
+    -n <runs>, --runs=<runs>            Times to run each command [default: 10]
+    -o <out>, --output=<out>            Write the results to <out> as JSON
+    -h, --help                          Show this help and exit
+
+"""
+
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = ('pacman', 'keyring', 'upgrade', 'manual', 'intervention', 'mirror',
+         'kernel', 'python', 'glibc', 'systemd', 'package', 'signature')
+
+def make_body(size, rand):
+    """ Return an HTML body of about 'size' bytes """
+    paragraphs = []
+    length = 0
+    while length < size:
+        words = ' '.join(rand.choice(WORDS) for _ in range(40))
+        paragraph = '<p>{} <a href="https://archlinux.org/">link</a> <code>{}</code></p>'.format(words, rand.choice(WORDS))
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return ''.join(paragraphs)[:size]
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def make_feed(index, entries, body_size):
+    """ Return the content of a generated feed, RSS for even 'index' and Atom
+    for odd """
+    rand = random.Random(index)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    items = []
+    for number in range(entries):
+        title = 'Feed {} item {}: {}'.format(index, number, ' '.join(rand.choice(WORDS) for _ in range(5)))
+        date = start - datetime.timedelta(hours=number * 7)
+        body = escape(make_body(body_size, rand))
+        if index % 2 == 0:
+            items.append('<item><title>{}</title><link>https://example.com/{}/{}</link>'
+                         '<description>{}</description><pubDate>{}</pubDate></item>'.format(
+                             escape(title), index, number, body,
+                             date.strftime('%a, %d %b %Y %H:%M:%S +0000')))
+        else:
+            items.append('<entry><title>{}</title><id>urn:feed-{}-{}</id><updated>{}</updated>'
+                         '<summary type="html">{}</summary></entry>'.format(
+                             escape(title), index, number,
+                             date.strftime('%Y-%m-%dT%H:%M:%SZ'), body))
+    if index % 2 == 0:
+        content = ('<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                   '<title>Feed {0}</title><link>https://example.com/{0}</link>'
+                   '<description>Generated feed</description>{1}</channel></rss>').format(index, ''.join(items))
+    else:
+        content = ('<?xml version="1.0" encoding="utf-8"?><feed xmlns="http://www.w3.org/2005/Atom">'
+                   '<title>Feed {0}</title><id>urn:feed-{0}</id><updated>2024-01-01T00:00:00Z</updated>'
+                   '{1}</feed>').format(index, ''.join(items))
+    return content.encode('utf-8')
+
+class FeedServer(http.server.ThreadingHTTPServer):
+    """ A local server for the generated feeds """
+    daemon_threads = True
+
+    def __init__(self, feeds, latency, error_rate, etags):
+        super().__init__(('127.0.0.1', 0), FeedHandler)
+        self.feeds = feeds
+        self.latency = latency
+        self.error_rate = error_rate
+        self.etags = etags
+        self.rand = random.Random(0)
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.latency)
+        content = server.feeds.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        if server.rand.random() < server.error_rate:
+            server.errors += 1
+            self.send_error(500)
+            return
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        if server.etags and self.headers.get('If-None-Match') == etag:
+            server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(content)))
+        if server.etags:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+def percentiles(samples):
+    """ Return the latency percentiles of 'samples' (in seconds) in ms """
+    samples = sorted(samples)
+    def pick(fraction):
+        return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 2)
+    return {
+        'min': round(samples[0] * 1000, 2),
+        'p50': pick(0.5),
+        'p90': pick(0.9),
+        'p99': pick(0.99),
+        'max': round(samples[-1] * 1000, 2),
+        'mean': round(statistics.mean(samples) * 1000, 2)
+    }
+
+def run_command(args, env):
+    """ Run informant with 'args' and return the wall-clock time in seconds
+    and the peak RSS in KiB """
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, '-m', 'informant.informant'] + args,
+                               env=env, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, _, usage = os.wait4(process.pid, 0)
+    process.returncode = 0 # already reaped by wait4
+    return time.monotonic() - start, usage.ru_maxrss
+
+def bench_commands(cfile, tmp_dir, runs):
+    """ Run each command 'runs' times and return their timings """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    env['INFORMANT_CACHE'] = os.path.join(tmp_dir, 'cache')
+    savefile = os.path.join(tmp_dir, 'informant.dat')
+    commands = {
+        'check': ['check'],
+        'check --no-cache': ['--no-cache', 'check'],
+        'list': ['list'],
+        'list --unread': ['list', '--unread'],
+        'read --all': ['read', '--all']
+    }
+    results = {}
+    for name, command in commands.items():
+        times = []
+        rss = []
+        cold = None
+        for run in range(runs + 1):
+            if os.path.exists(savefile):
+                os.remove(savefile)
+            elapsed, max_rss = run_command(['-c', cfile, '-f', savefile] + command, env)
+            if run == 0:
+                cold = elapsed # the first run may have had to fill the cache
+                continue
+            times.append(elapsed)
+            rss.append(max_rss)
+        results[name] = {
+            'latency_ms': percentiles(times),
+            'first_run_ms': round(cold * 1000, 2),
+            'peak_rss_kib': max(rss)
+        }
+        print('{}: p50 {}ms p90 {}ms, peak rss {} KiB'.format(
+            name, results[name]['latency_ms']['p50'], results[name]['latency_ms']['p90'], max(rss)))
+    return results
+
+def timed(stages, name, function, *args):
+    """ Run 'function' with 'args', add its time to 'stages' and return its
+    result """
+    start = time.monotonic()
+    result = function(*args)
+    stages[name] = round((time.monotonic() - start) * 1000, 2)
+    return result
+
+def bench_stages(url, timestamp_key, tmp_dir):
+    """ Time each stage of building, checking and showing one feed """
+    import feedparser
+    import requests
+    from dateutil import parser as date_parser
+
+    from informant.config import InformantConfig
+    from informant.entry import Entry
+    from informant.readlist import Readlist, load as load_readlist
+    from informant.timestamp import TimestampParser
+    import informant.ui as ui
+
+    InformantConfig().set_argv({})
+    InformantConfig().config = {}
+    def fetch():
+        # retry past the errors the server was asked to make
+        for _ in range(20):
+            response = requests.get(url)
+            if response.ok:
+                break
+        return response
+
+    stages = {}
+    response = timed(stages, 'fetch', fetch)
+    stages['bytes'] = len(response.content)
+    feed = timed(stages, 'feedparser', feedparser.parse, response.content)
+    items = feed.entries
+    timed(stages, 'dateutil', lambda: [date_parser.parse(item[timestamp_key]) for item in items])
+    parser = TimestampParser()
+    timestamps = timed(stages, 'timestamp', lambda: [parser.parse(item[timestamp_key]) for item in items])
+    entries = timed(stages, 'entry', lambda: [Entry(item['title'], timestamp, item['summary'], 'bench')
+                                              for item, timestamp in zip(items, timestamps)])
+    entries = timed(stages, 'sort', lambda: sorted(entries, key=lambda k: k.timestamp, reverse=True))
+
+    readlist = Readlist()
+    InformantConfig().readlist = readlist
+    for entry in entries[::2]:
+        readlist.add(entry.read_key)
+    timed(stages, 'readlist_lookup', lambda: [entry.has_been_read() for entry in entries])
+    savefile = os.path.join(tmp_dir, 'stages.dat')
+    readlist.rewrite = True
+    timed(stages, 'readlist_save', readlist.save, savefile)
+    timed(stages, 'readlist_load', load_readlist, savefile)
+
+    timed(stages, 'render_list', lambda: list(ui.format_list(entries)))
+    sample = entries[:50]
+    def render_bodies():
+        return [ui.format_body(entry.body) for entry in sample]
+    # html2text alone, then filling the (empty) render cache, then a later
+    # run reading it back: the bodies are only in the cache directory then
+    InformantConfig().set_argv({'--no-cache': True})
+    timed(stages, 'render_body_uncached_{}'.format(len(sample)), render_bodies)
+    InformantConfig().set_argv({})
+    ui._rendered.clear()
+    timed(stages, 'render_body_cold_{}'.format(len(sample)), render_bodies)
+    ui._rendered.clear()
+    timed(stages, 'render_body_warm_{}'.format(len(sample)), render_bodies)
+    stages['entries'] = len(entries)
+    return stages
+
+def main():
+    argv = docopt.docopt(__doc__)
+    entries = int(argv['--entries'])
+    feed_count = int(argv['--feeds'])
+    body_size = int(argv['--body-size'])
+    runs = int(argv['--runs'])
+
+    print('generating {} feeds of {} entries'.format(feed_count, entries))
+    feeds = {'/feed{}.xml'.format(index): make_feed(index, entries, body_size) for index in range(feed_count)}
+    server = FeedServer(feeds, int(argv['--latency']) / 1000, float(argv['--error-rate']), not argv['--no-etag'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cfile = os.path.join(tmp_dir, 'informantrc.json')
+        with open(cfile, 'w') as cfg:
+            json.dump({'feeds': [{
+                'name': 'Feed {}'.format(index),
+                'url': base + path,
+                'timestamp-key': 'published' if index % 2 == 0 else 'updated'
+            } for index, path in enumerate(sorted(feeds))]}, cfg)
+
+        commands = bench_commands(cfile, tmp_dir, runs)
+        # the stages run in this process, which must not use the real cache
+        # either; set before informant is first imported by bench_stages()
+        os.environ['INFORMANT_CACHE'] = os.path.join(tmp_dir, 'stages-cache')
+        stages = {}
+        for index, path in enumerate(sorted(feeds)):
+            timestamp_key = 'published' if index % 2 == 0 else 'updated'
+            stages[path] = bench_stages(base + path, timestamp_key, tmp_dir)
+            print('{}: {}'.format(path, stages[path]))
+
+    results = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': sys.version.split()[0],
+        'parameters': {
+            'entries': entries,
+            'feeds': feed_count,
+            'body_size': body_size,
+            'latency_ms': int(argv['--latency']),
+            'error_rate': float(argv['--error-rate']),
+            'etags': not argv['--no-etag'],
+            'runs': runs
+        },
+        'server': {
+            'requests': server.requests,
+            'not_modified': server.not_modified,
+            'errors': server.errors
+        },
+        'commands': commands,
+        'stages_ms': stages
+    }
+    server.shutdown()
+    if argv['--output']:
+        with open(argv['--output'], 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+"""
+benchmarks/startup.py - measure how long informant takes to start up
+
+Usage:
+    startup.py [options] <cfile>
+
+Runs 'informant check' with the config file <cfile> and reports the time it
+takes to import informant, a cold check (without using the cache) and a warm
+check (after the cache has been filled). The save file used is a copy and the
+cache is a temporary directory, so the real readlist and cache are never
+changed.
+
+Options:
+    -f <file>, --file=<file>        Copy <file> as the save file to check with
+    -n <runs>, --runs=<runs>        Number of times to run each measurement
+                                    [default: 5]
+    -o <out>, --output=<out>        Append the results to <out> as a line of
+                                    JSON, to compare them between releases
+    -h, --help                      Show this help and exit
+
+"""
+
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should only be imported when they are needed
+HEAVY_MODULES = ('requests', 'feedparser', 'dateutil', 'cachecontrol', 'html2text', 'psutil')
+
+LOADED_SCRIPT = """
+import runpy, sys
+sys.argv = ['informant'] + sys.argv[1:]
+try:
+    runpy.run_module('informant.informant', run_name='__main__')
+except SystemExit:
+    pass
+print(' '.join(sorted(m for m in {!r} if m in sys.modules)), file=sys.stderr)
+""".format(HEAVY_MODULES)
+
+def get_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    return env
+
+def import_time():
+    """ Return the cumulative import time of informant in milliseconds """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import informant.informant'],
+                            env=get_env(), stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| informant\.informant$', line)
+        if match:
+            return int(match.group(1)) / 1000
+    return None
+
+def run_check(args):
+    """ Run informant check with 'args' and return the wall-clock time in
+    milliseconds """
+    start = time.monotonic()
+    subprocess.run([sys.executable, '-m', 'informant.informant'] + args + ['check'],
+                   env=get_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.monotonic() - start) * 1000
+
+def loaded_modules(args):
+    """ Return the heavy modules that a check with 'args' imports """
+    result = subprocess.run([sys.executable, '-c', LOADED_SCRIPT] + args + ['check'],
+                            env=get_env(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    lines = result.stderr.splitlines()
+    return lines[-1].split() if lines else []
+
+def get_version():
+    with open(os.path.join(ROOT, 'informant', 'informant.py')) as version_file:
+        return re.findall(r"^__version__ = '(.*)'", version_file.read(), re.MULTILINE)[0]
+
+def main():
+    argv = docopt.docopt(__doc__)
+    runs = int(argv['--runs'])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ['INFORMANT_CACHE'] = os.path.join(tmp_dir, 'cache')
+        savefile = os.path.join(tmp_dir, 'informant.dat')
+        if argv['--file']:
+            shutil.copy(argv['--file'], savefile)
+        args = ['-c', argv['<cfile>'], '-f', savefile]
+
+        imports = [import_time() for _ in range(runs)]
+        cold = [run_check(args + ['--no-cache']) for _ in range(runs)]
+        run_check(args) # fill the cache
+        warm = [run_check(args) for _ in range(runs)]
+        results = {
+            'version': get_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'runs': runs,
+            'import_ms': round(statistics.median(imports), 1),
+            'cold_check_ms': round(statistics.median(cold), 1),
+            'warm_check_ms': round(statistics.median(warm), 1),
+            'warm_check_modules': loaded_modules(args)
+        }
+
+    for key, value in results.items():
+        print('{}: {}'.format(key, value))
+    if argv['--output']:
+        with open(argv['--output'], 'a') as output:
+            output.write(json.dumps(results) + '\n')
+
+if __name__ == '__main__':
+    main()
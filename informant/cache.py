@@ -0,0 +1,179 @@
+"""
+informant/cache.py
+
+This module manages the cache directory: it keeps it under 'cache-max-size' by
+evicting the least recently used files, removes the cached entries of feeds
+that are older than their 'cache-ttl' and keeps the per feed statistics shown
+by `informant cache stats`.
+"""
+
+import datetime
+import json
+import os
+import time
+
+from informant.config import ARCH_NEWS, InformantConfig
+import informant.file as fs
+import informant.lock as lock
+import informant.trace as trace
+import informant.ui as ui
+
+EVICT_TO = 0.9 # evicting stops once the cache is this fraction of its maximum
+TMP_MAX_AGE = 60 * 60 # seconds after which a temporary file was left by a crash
+STATS_NAME = 'stats.json'
+KEEP_NAMES = ('snapshot', 'search', 'config', STATS_NAME) # never evicted
+MAINTAIN_INTERVAL = 24 * 60 * 60 # seconds between walks of the cache when nothing new was cached
+MAINTAINED_KEY = 'maintained' # when the cache was last walked, in the statistics
+
+def stats_path():
+    """ Return the path of the saved cache statistics """
+    return os.path.join(InformantConfig().get_cachefile(), STATS_NAME)
+
+def read_stats():
+    """ Return the saved cache statistics, a dict of feed URL to a dict of the
+    feed's name, hits, misses, downloaded bytes and last validation time """
+    try:
+        with open(stats_path(), 'rb') as stats_file:
+            return json.loads(stats_file.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+def update_stats(feeds):
+    """ Add how the 'feeds' that were fetched used the cache to the saved
+    statistics. Returns True if the cache should be maintained now: a feed
+    had to be cached again, or it hasn't been for MAINTAIN_INTERVAL. """
+    fetched = [feed for feed in feeds if feed.cache_hit is not None]
+    if not fetched:
+        return False
+    now = time.time()
+    due = any(not feed.cache_hit for feed in fetched)
+    filename = stats_path()
+    try:
+        fs.makedirs(os.path.dirname(filename))
+        with trace.span('cache.stats'), lock.open_locked(filename, mode=0o0664) as (stats_file, _):
+            stats_file.seek(0)
+            try:
+                stats = json.loads(stats_file.read().decode('utf-8'))
+            except ValueError:
+                stats = {}
+            for feed in fetched:
+                feed_stats = stats.setdefault(feed.url, {'hits': 0, 'misses': 0, 'downloaded': 0})
+                feed_stats['name'] = feed.name
+                feed_stats['hits' if feed.cache_hit else 'misses'] += 1
+                feed_stats['downloaded'] += feed.downloaded
+                if feed.validated is not None:
+                    feed_stats['validated'] = feed.validated
+            if due or now - stats.get(MAINTAINED_KEY, 0) > MAINTAIN_INTERVAL:
+                due = True
+                stats[MAINTAINED_KEY] = now
+            fs.write_atomic(filename, json.dumps(stats).encode('utf-8'))
+    except OSError as e:
+        ui.debug_print('Unable to save cache statistics: {}'.format(e))
+    return due
+
+def remove(filename):
+    """ Remove the cache file 'filename' and its lock file """
+    for path in (filename, filename + '.lock'):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def maintain(feeds):
+    """ Remove the cached entries of 'feeds' that are older than their
+    'cache-ttl', then evict the least recently used files until the cache is
+    smaller than 'cache-max-size'. Returns the number of files removed. """
+    cache_dir = InformantConfig().get_cachefile()
+    max_size = InformantConfig().get_cache_max_size()
+    ttls = {fs.entry_cache_path(feed.url): feed.cache_ttl for feed in feeds if feed.cache_ttl is not None}
+    now = time.time()
+    removed = 0
+    files = []
+    total = 0
+    with trace.span('cache.maintain'):
+        for dirpath, _, filenames in os.walk(cache_dir):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                # lock files are removed with the file they lock
+                if name.endswith('.lock') or (dirpath == cache_dir and name in KEEP_NAMES):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > TMP_MAX_AGE:
+                        remove(path)
+                        removed += 1
+                    continue
+                if path in ttls and now - stat.st_mtime > ttls[path]:
+                    remove(path)
+                    removed += 1
+                    continue
+                files.append((stat.st_atime, stat.st_size, path))
+                total += stat.st_size
+        if total > max_size:
+            ui.debug_print('cache is {:d} bytes, evicting down to {:d}'.format(total, int(max_size * EVICT_TO)))
+            files.sort()
+            for _, size, path in files:
+                if total <= max_size * EVICT_TO:
+                    break
+                remove(path)
+                removed += 1
+                total -= size
+    trace.count('cache.evictions', removed)
+    return removed
+
+def get_size(filename):
+    """ Return the size of 'filename' in bytes, 0 if it doesn't exist """
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def format_size(size):
+    """ Return the number of bytes 'size' in a human readable form """
+    if size < 1024:
+        return '{:d} B'.format(size)
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return '{:.1f} {}'.format(size, unit)
+
+def print_stats(feed_configs):
+    """ Print the size of the cache and, for the feeds in 'feed_configs', how
+    often their cached copy was still valid, how much was downloaded and
+    stored for them and when they were last validated with the server """
+    cache_dir = InformantConfig().get_cachefile()
+    total = 0
+    count = 0
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for name in filenames:
+            total += get_size(os.path.join(dirpath, name))
+            count += 1
+    print('Cache directory: {}'.format(cache_dir))
+    print('Size: {} of {} in {:d} files{}'.format(
+        format_size(total), format_size(InformantConfig().get_cache_max_size()), count,
+        ' (compressed)' if InformantConfig().get_cache_compress() else ''))
+
+    try:
+        import informant.httpcache as httpcache
+    except ImportError:
+        httpcache = None
+    stats = read_stats()
+    print('{:<28} {:>6} {:>6} {:>8} {:>11} {:>11}  {}'.format(
+        'Feed', 'Hits', 'Misses', 'Hit rate', 'Downloaded', 'Cached', 'Last validated'))
+    for feed_config in feed_configs:
+        url = feed_config.get('url', ARCH_NEWS)
+        feed_stats = stats.get(url, {})
+        hits = feed_stats.get('hits', 0)
+        misses = feed_stats.get('misses', 0)
+        cached = get_size(fs.entry_cache_path(url))
+        if httpcache is not None:
+            cached += get_size(httpcache.cache_path(cache_dir, url))
+        validated = feed_stats.get('validated')
+        print('{:<28} {:>6d} {:>6d} {:>8} {:>11} {:>11}  {}'.format(
+            (feed_config.get('name') or url)[:28], hits, misses,
+            '{:.1f}%'.format(hits * 100 / (hits + misses)) if hits + misses else '-',
+            format_size(feed_stats.get('downloaded', 0)), format_size(cached),
+            datetime.datetime.fromtimestamp(validated).strftime('%Y-%m-%d %H:%M:%S') if validated else 'never'))
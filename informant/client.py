@@ -0,0 +1,106 @@
+"""
+informant/client.py
+
+This module talks to the readlist server started by `informant serve`. While
+it is running the readlist is loaded from and saved to the server instead of
+the save file, and the snapshot is read from it. When it isn't informant uses
+the files as usual.
+"""
+
+import json
+import os
+import socket
+
+from informant.config import FILE_OPT, InformantConfig
+from informant.readlist import Readlist
+import informant.trace as trace
+import informant.ui as ui
+
+CLIENT_TIMEOUT = 10 # seconds to wait for the server to answer
+
+class ServerError(OSError):
+    """ Raised when the readlist server can't be reached or refuses a request """
+
+class Connection:
+    """ A connection to the readlist server """
+
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(CLIENT_TIMEOUT)
+        try:
+            self.sock.connect(socket_path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, op, **args):
+        """ Send the request 'op' with 'args' and return the response """
+        args['op'] = op
+        with trace.span('server.' + op):
+            try:
+                self.file.write(json.dumps(args).encode('utf-8') + b'\n')
+                self.file.flush()
+                line = self.file.readline()
+            except OSError as e:
+                raise ServerError('the readlist server did not answer: {}'.format(e))
+        if not line:
+            raise ServerError('the readlist server closed the connection')
+        try:
+            response = json.loads(line)
+        except ValueError:
+            raise ServerError('the readlist server sent an invalid response')
+        if 'error' in response:
+            raise ServerError('the readlist server refused: {}'.format(response['error']))
+        return response
+
+_connection = None  # the Connection, False if there is none to use
+
+def disable():
+    """ Never use the readlist server from this process """
+    global _connection
+    _connection = False
+
+def connect():
+    """ Return the Connection to the readlist server, or None if it isn't
+    running. The server isn't used with an explicit --file. """
+    global _connection
+    if _connection is None:
+        _connection = False
+        socket_path = InformantConfig().get_socket()
+        if InformantConfig().get_argv().get(FILE_OPT) or not os.path.exists(socket_path):
+            return None
+        try:
+            _connection = Connection(socket_path)
+        except OSError as e:
+            ui.debug_print('Not using the readlist server at "{}": {}'.format(socket_path, e))
+    return _connection or None
+
+class RemoteReadlist(Readlist):
+    """ A Readlist kept by the readlist server. Lookups use the keys loaded
+    from the server, saving sends the changes to it in one request. """
+
+    def __init__(self, connection, keys=(), clear=False):
+        super().__init__(keys, clear=clear)
+        self.connection = connection
+
+    def needs_checkpoint(self):
+        return False # the server checkpoints its own save files
+
+    def save(self, filename=None, timeout=None):
+        if not self.rewrite and not self.pending:
+            return
+        if self.rewrite:
+            keys = self.keys if self.clear else self.pending
+            self.connection.request('rewrite', user=InformantConfig().get_user(), keys=list(keys),
+                                    removed=list(self.removed), clear=self.clear)
+        else:
+            self.connection.request('add', user=InformantConfig().get_user(), keys=self.pending)
+        self.pending = []
+        self.removed = set()
+        self.rewrite = False
+        self.clear = False
+
+def load_readlist(connection):
+    """ Return our readlist from the server at 'connection' """
+    return RemoteReadlist(connection, connection.request('load', user=InformantConfig().get_user())['keys'])
@@ -5,9 +5,12 @@ This module contains helpers to manage arguments, options and configuration
 settings provided to Informant.
 """
 
+import difflib
 import json
 import os
 
+import informant.trace as trace
+
 DEBUG_OPT = '--debug'
 FILE_OPT = '--file'
 CFILE_OPT = '--config'
@@ -15,11 +18,185 @@ NOCACHE_OPT = '--no-cache'
 CLRCACHE_OPT = '--clear-cache'
 CLRREAD_OPT = '--clear-readlist'
 PAGER_OPT = '--pager'
+PROFILE_OPT = '--profile'
+OFFLINE_OPT = '--offline'
+TRACE_OPT = '--trace'
 
 FILE_DEFAULT = '/var/lib/informant.dat' # readlist save file
-CACHE_DEFAULT = '/var/cache/informant' # http caching
+READLIST_DIR_DEFAULT = '/var/lib/informant' # per user readlists kept by 'informant serve'
+SOCKET_DEFAULT = os.environ.get('INFORMANT_SOCKET', default='/run/informant.sock') # readlist server
+CACHE_DEFAULT = os.environ.get('INFORMANT_CACHE', default='/var/cache/informant') # http caching
 CONFIG_BASE = 'informantrc.json' # user config
+COMPILED_NAME = 'config' # the compiled config, in the cache directory
+COMPILED_VERSION = 2
 PAGER_DEFAULT = os.environ.get('INFORMANT_PAGER', default=None)
+PARALLEL_DEFAULT = 8 # number of feeds fetched at once
+TIMEOUT_DEFAULT = [5, 15] # per feed connect and read timeouts in seconds
+CHECK_BUDGET_DEFAULT = 30 # seconds 'check' may spend fetching all feeds
+RETRIES_DEFAULT = 2 # times a failed feed request is retried
+CACHE_MAX_SIZE_DEFAULT = 50 # MiB the cache directory may use
+ARCH_NEWS = 'https://archlinux.org/feeds/news/' # the feed used if none are configured
+
+PARALLEL_KEY = 'max-parallel'
+TIMEOUT_KEY = 'timeout'
+CHECK_BUDGET_KEY = 'check-budget'
+RETRIES_KEY = 'retries'
+PROXIES_KEY = 'proxies'
+CACHE_MAX_SIZE_KEY = 'cache-max-size'
+CACHE_COMPRESS_KEY = 'cache-compress'
+MAX_AGE_KEY = 'readlist-max-age'
+AUTO_COMPACT_KEY = 'auto-compact'
+READ_STREAK_KEY = 'read-streak'
+SNAPSHOT_AGE_KEY = 'snapshot-max-age'
+FEEDS_KEY = 'feeds'
+
+class ConfigError(ValueError):
+    """ Raised when the config file can't be used at all """
+
+def is_text(value):
+    return isinstance(value, str)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def is_positive(value):
+    return is_count(value) and value > 0
+
+def is_timeout(value):
+    return is_number(value) or (isinstance(value, list) and len(value) == 2 and all(is_number(v) for v in value))
+
+def is_flag(value):
+    return isinstance(value, bool) or value in (0, 1)
+
+def is_proxies(value):
+    return isinstance(value, dict) and all(is_text(v) for v in value.values())
+
+# the check and the description of the values each setting may have
+OPTION_TYPES = {
+    PARALLEL_KEY: (is_positive, 'a whole number above 0'),
+    TIMEOUT_KEY: (is_timeout, 'a number of seconds or a [connect, read] pair'),
+    CHECK_BUDGET_KEY: (is_number, 'a number of seconds'),
+    RETRIES_KEY: (is_count, 'a whole number'),
+    PROXIES_KEY: (is_proxies, 'an object of URL scheme to proxy URL'),
+    CACHE_MAX_SIZE_KEY: (is_number, 'a number of MiB'),
+    CACHE_COMPRESS_KEY: (is_flag, 'true or false'),
+    MAX_AGE_KEY: (is_number, 'a number of days'),
+    AUTO_COMPACT_KEY: (is_flag, 'true or false'),
+    READ_STREAK_KEY: (is_count, 'a whole number'),
+    SNAPSHOT_AGE_KEY: (is_number, 'a number of seconds'),
+    FEEDS_KEY: (lambda value: isinstance(value, list), 'a list of feeds'),
+}
+FEED_TYPES = {
+    'name': (is_text, 'a string'),
+    'url': (is_text, 'a string'),
+    'title-key': (is_text, 'a string'),
+    'body-key': (is_text, 'a string'),
+    'timestamp-key': (is_text, 'a string'),
+    'timeout': (is_timeout, 'a number of seconds or a [connect, read] pair'),
+    'max-items': (is_positive, 'a whole number above 0'),
+    'max-body-bytes': (is_positive, 'a whole number above 0'),
+    'cache-ttl': (is_number, 'a number of seconds'),
+}
+# a compiled feed has every key, 'timeout' comes from the settings if unset
+FEED_DEFAULTS = {
+    'name': None,
+    'url': ARCH_NEWS,
+    'title-key': 'title',
+    'body-key': 'summary',
+    'timestamp-key': 'published',
+    'timeout': None,
+    'max-items': None,
+    'max-body-bytes': None,
+    'cache-ttl': None,
+}
+
+def unknown_key(key, known):
+    """ Return the warning for the unknown setting 'key', suggesting the one
+    in 'known' it is most likely a misspelling of """
+    message = 'unknown setting "{}"'.format(key)
+    close = difflib.get_close_matches(key, known, n=1)
+    if close:
+        message += ', did you mean "{}"?'.format(close[0])
+    return message
+
+def bad_value(key, value, kind):
+    """ Return the error for the setting 'key' having the wrong kind of value """
+    return '"{}" must be {}, not {}'.format(key, kind, json.dumps(value))
+
+def compile_feed(feed_config, timeout):
+    """ Return the compiled feed of 'feed_config' and its warnings, or None
+    and its errors if it can't be used """
+    compiled = dict(FEED_DEFAULTS, timeout=timeout)
+    warnings = []
+    errors = []
+    for key, value in feed_config.items():
+        if key not in FEED_TYPES:
+            warnings.append(unknown_key(key, FEED_TYPES))
+            continue
+        check, kind = FEED_TYPES[key]
+        if not check(value):
+            errors.append(bad_value(key, value, kind))
+            continue
+        compiled[key] = value
+    if errors:
+        return None, errors
+    return compiled, warnings
+
+def compile_config(config):
+    """ Check the settings and feeds of the parsed config file 'config' and
+    return them ready to use, along with the warnings (unknown settings) and
+    errors (settings that were ignored, feeds that were skipped) to report.
+    Raises ConfigError if 'config' isn't a JSON object. """
+    if not isinstance(config, dict):
+        raise ConfigError('the config must be a JSON object, not {}'.format(json.dumps(config)[:40]))
+    options = {}
+    warnings = []
+    errors = []
+    for key, value in config.items():
+        if key not in OPTION_TYPES:
+            warnings.append(unknown_key(key, OPTION_TYPES))
+            continue
+        check, kind = OPTION_TYPES[key]
+        if not check(value):
+            errors.append(bad_value(key, value, kind) + ', using the default')
+            continue
+        options[key] = value
+
+    feeds = []
+    timeout = options.get(TIMEOUT_KEY, TIMEOUT_DEFAULT)
+    for index, feed_config in enumerate(options.pop(FEEDS_KEY, [{}])):
+        label = 'feed {:d}'.format(index + 1)
+        if not isinstance(feed_config, dict):
+            errors.append('{} must be an object, skipping it'.format(label))
+            continue
+        if is_text(feed_config.get('name')):
+            label += ' ("{}")'.format(feed_config['name'])
+        compiled, messages = compile_feed(feed_config, timeout)
+        if compiled is None:
+            errors.extend('{}: {}, skipping it'.format(label, message) for message in messages)
+            continue
+        warnings.extend('{}: {}'.format(label, message) for message in messages)
+        feeds.append(compiled)
+    return options, feeds, warnings, errors
+
+def config_paths(cfile_option=None):
+    """ Return the files the config is looked for in, in order: the --config
+    file, ~/.informantrc.json, $XDG_CONFIG_HOME/informantrc.json,
+    /etc/informantrc.json and informantrc.json in each of $XDG_CONFIG_DIRS """
+    home = os.path.expanduser('~')
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(home, '.config')
+    config_dirs = os.environ.get('XDG_CONFIG_DIRS') or '/etc/xdg'
+    paths = [os.path.join(home, '.' + CONFIG_BASE),
+             os.path.join(config_home, CONFIG_BASE),
+             os.path.join('/etc', CONFIG_BASE)]
+    # relative paths in the XDG variables are invalid and should be ignored
+    paths += [os.path.join(dirname, CONFIG_BASE) for dirname in config_dirs.split(':') if os.path.isabs(dirname)]
+    if cfile_option:
+        paths.insert(0, cfile_option)
+    return paths
 
 class Singleton(type):
     """ A Singleton class to be used as a base """
@@ -36,6 +213,9 @@ class InformantConfig(metaclass=Singleton):
     def __init__(self):
         self.argv = {}
         self.config = None
+        self.feeds = None  # the compiled feeds of the config
+        self.config_warnings = []
+        self.config_errors = []
         self.colors = {
                 'RED': '\033[0;31m',
                 'YELLOW': '\033[1;33m',
@@ -54,6 +234,20 @@ class InformantConfig(metaclass=Singleton):
     def get_argv_debug(self):
         return self.argv.get(DEBUG_OPT)
 
+    def get_argv_profile(self):
+        """ Return True if a table of timings should be printed at exit. The
+        debug option also prints it. """
+        return bool(self.argv.get(PROFILE_OPT) or self.argv.get(DEBUG_OPT))
+
+    def get_argv_trace(self):
+        """ Return the file to write a JSON lines timing trace to, or None """
+        return self.argv.get(TRACE_OPT)
+
+    def get_argv_offline(self):
+        """ Return True if feeds should only be read from the snapshot (or
+        the cache) instead of being fetched. """
+        return bool(self.argv.get(OFFLINE_OPT))
+
     def get_argv_use_cache(self):
         """ Return True if we should use the cache, else False.
         Providing the NOCACHE_OPT means that we should not use the cache.
@@ -83,10 +277,46 @@ class InformantConfig(metaclass=Singleton):
 
 
     def get_savefile(self):
+        """ Return the save file to use: the --file option, else the readlist
+        'informant serve' keeps for us if it has made one (so that what was
+        read through it stays read when it isn't running), else the save file
+        shared by all users. """
+        if self.argv.get(FILE_OPT):
+            return self.argv.get(FILE_OPT)
+        user_savefile = self.get_user_savefile(self.get_user())
+        if os.path.exists(user_savefile):
+            return user_savefile
+        return FILE_DEFAULT
+
+    def get_shared_savefile(self):
+        """ Return the save file shared by all users, the --file option if
+        given """
         if self.argv.get(FILE_OPT):
             return self.argv.get(FILE_OPT)
         return FILE_DEFAULT
 
+    def get_user_savefile(self, uid):
+        """ Return the save file 'informant serve' keeps the readlist of the
+        user 'uid' in """
+        return os.path.join(self.get_readlist_dir(), '{:d}.dat'.format(uid))
+
+    def get_user(self):
+        """ Return the user whose read state to use: the user running sudo when
+        running as root through sudo (e.g. the pacman hook), else our own """
+        uid = os.getuid()
+        if uid == 0 and os.environ.get('SUDO_UID', '').isdigit():
+            return int(os.environ['SUDO_UID'])
+        return uid
+
+    def get_socket(self):
+        """ Return the path of the readlist server's socket """
+        return SOCKET_DEFAULT
+
+    def get_readlist_dir(self):
+        """ Return the directory the readlist server keeps each user's
+        readlist in """
+        return READLIST_DIR_DEFAULT
+
     def set_config(self, config):
         self.config = config
 
@@ -95,36 +325,144 @@ class InformantConfig(metaclass=Singleton):
             return self.argv.get(PAGER_OPT)
         return PAGER_DEFAULT
 
-    def read_config(self):
-        self.config = {}
+    def get_max_parallel(self):
+        """ Return the maximum number of feeds to fetch at once. """
+        return max(1, int(self.get_config().get(PARALLEL_KEY, PARALLEL_DEFAULT)))
+
+    def get_timeout(self):
+        """ Return the default feed timeout, either a number of seconds or a
+        [connect, read] pair. """
+        return self.get_config().get(TIMEOUT_KEY, TIMEOUT_DEFAULT)
+
+    def get_check_budget(self):
+        """ Return the number of seconds 'check' may spend fetching feeds. """
+        return self.get_config().get(CHECK_BUDGET_KEY, CHECK_BUDGET_DEFAULT)
+
+    def get_retries(self):
+        """ Return the number of times a failed feed request is retried. """
+        return max(0, int(self.get_config().get(RETRIES_KEY, RETRIES_DEFAULT)))
+
+    def get_proxies(self):
+        """ Return the proxies to use for feed requests as a mapping from URL
+        scheme to proxy URL, empty to only use the proxy environment
+        variables. """
+        return self.get_config().get(PROXIES_KEY, {})
+
+    def get_cache_max_size(self):
+        """ Return the number of bytes the cache directory may use. """
+        return int(float(self.get_config().get(CACHE_MAX_SIZE_KEY, CACHE_MAX_SIZE_DEFAULT)) * 1024 * 1024)
+
+    def get_cache_compress(self):
+        """ Return True if cached feeds and items should be compressed. """
+        return bool(self.get_config().get(CACHE_COMPRESS_KEY, False))
+
+    def get_readlist_max_age(self):
+        """ Return the age in days after which read items may be removed from
+        the readlist, or None if they are only removed once no feed returns
+        them. """
+        return self.get_config().get(MAX_AGE_KEY)
+
+    def get_auto_compact(self):
+        """ Return True if the readlist should be compacted on every run. """
+        return bool(self.get_config().get(AUTO_COMPACT_KEY, False))
+
+    def get_read_streak(self):
+        """ Return the number of read items in a row after which 'check' and
+        'list --unread' stop looking for unread items, 0 to never stop early.
+        """
+        return int(self.get_config().get(READ_STREAK_KEY, 0))
+
+    def get_snapshot_max_age(self):
+        """ Return how many seconds old the snapshot can be for 'check' to
+        use it instead of fetching, or None to always fetch. """
+        return self.get_config().get(SNAPSHOT_AGE_KEY)
+
+    def find_config(self):
+        """ Return the config file to use and its os.stat, or None and None if
+        there isn't one """
         cfile_option = self.argv.get(CFILE_OPT)
-        cfg_fname = None
-        if cfile_option and os.path.exists(cfile_option):
-            cfg_fname = cfile_option
-        elif os.path.exists(os.path.expandvars('$HOME/.' + CONFIG_BASE)):
-            cfg_fname = os.path.expandvars('$HOME/.' + CONFIG_BASE)
-        elif os.path.exists(os.path.expandvars('$XDG_CONFIG_HOME/' + CONFIG_BASE)):
-            cfg_fname = os.path.expandvars('$XDG_CONFIG_HOME/' + CONFIG_BASE)
-        elif os.path.exists(os.path.join('/etc/', CONFIG_BASE)):
-            cfg_fname = os.path.join('/etc/', CONFIG_BASE)
-        else:
-            xdg_config_dirs = os.environ.get('$XDG_CONFIG_DIRS')
-            if xdg_config_dirs:
-                xdg_config_dirs = [xdg_config_dirs.split(':')]
-                for dirname in xdg_config_dirs:
-                    if os.path.exists(os.path.join(dirname, CONFIG_BASE)):
-                        cfg_fname = os.path.join(dirname, CONFIG_BASE)
-                        break
+        for cfg_fname in config_paths(cfile_option):
+            try:
+                return cfg_fname, os.stat(cfg_fname)
+            except OSError:
+                if cfg_fname == cfile_option:
+                    self.config_warnings.append('config file "{}" does not exist'.format(cfile_option))
+        return None, None
+
+    def read_config(self):
+        """ Read, check and compile the config file. The compiled config is
+        saved in the cache directory, so as long as the file doesn't change
+        later runs don't have to parse and check it again. Raises ConfigError
+        if the config file can't be used. """
+        cfg_fname, stat = self.find_config()
         if self.get_argv_debug():
             self.debug_print('cfg_fname: {}'.format(cfg_fname))
+        key = None
+        compiled = None
         if cfg_fname is not None:
-            with open(cfg_fname, 'r') as cfg:
-                self.config = json.loads(cfg.read())
+            key = [COMPILED_VERSION, os.path.abspath(cfg_fname), stat.st_mtime_ns, stat.st_size]
+            with trace.span('config.load'):
+                compiled = self.read_compiled(key)
+        if compiled is None:
+            config = {}
+            if cfg_fname is not None:
+                try:
+                    with trace.span('config.parse'), open(cfg_fname, 'r') as cfg:
+                        config = json.loads(cfg.read())
+                except (OSError, ValueError) as e:
+                    raise ConfigError('Unable to read config file "{}": {}'.format(cfg_fname, e))
+            try:
+                compiled = compile_config(config)
+            except ConfigError as e:
+                raise ConfigError('Unable to use config file "{}": {}'.format(cfg_fname, e))
+            if key is not None:
+                self.save_compiled(key, compiled)
+        else:
+            trace.count('config_cache.hits')
+            if self.get_argv_debug():
+                self.debug_print('using the compiled config saved for {}'.format(cfg_fname))
+        self.config, self.feeds, warnings, errors = compiled
+        self.config_warnings.extend(warnings)
+        self.config_errors.extend(errors)
         if self.get_argv_debug():
             self.debug_print('config: {}'.format(self.config))
         return self.config
 
+    def read_compiled(self, key):
+        """ Return the compiled config saved for 'key', or None """
+        if not self.get_argv_use_cache():
+            return None
+        try:
+            # JSON, the cache directory is shared so this must not run code
+            with open(os.path.join(self.get_cachefile(), COMPILED_NAME), 'rb') as compiled_file:
+                saved = json.loads(compiled_file.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get('key') != key:
+            return None
+        return saved['compiled']
+
+    def save_compiled(self, key, compiled):
+        """ Save the 'compiled' config for 'key' """
+        if not self.get_argv_use_cache():
+            return
+        # imported here, informant.file needs this module
+        import informant.file as fs
+        try:
+            fs.write_atomic(os.path.join(self.get_cachefile(), COMPILED_NAME),
+                            fs.dump_json({'key': key, 'compiled': compiled}))
+        except OSError as e:
+            if self.get_argv_debug():
+                self.debug_print('Unable to save the compiled config: {}'.format(e))
+
     def get_config(self):
         if self.config is None:
             return self.read_config()
         return self.config
+
+    def get_feeds(self):
+        """ Return the compiled feeds of the config, dicts with every feed
+        setting. The Arch Linux news is used if no feeds are configured. """
+        if self.feeds is None:
+            self.read_config()
+        return self.feeds
@@ -4,33 +4,96 @@ informant/entry.py
 This module contains entry (feed item) related functions.
 """
 
+import datetime
+
 from informant.config import InformantConfig
+import informant.trace as trace
 import informant.ui as ui
 
 class Entry:
+    __slots__ = ('title', 'timestamp', 'body', 'feed_name', 'read_key', '_pretty_date', '_read')
+
     def __init__(self, title, timestamp, body, feed_name):
         self.title = title
         self.timestamp = timestamp
-        self.pretty_date = timestamp.strftime('%a, %d %b %Y %H:%M:%S %z')
         self.body = body
         self.feed_name = feed_name
+        # the key used to save this entry in the readlist
+        self.read_key = str(timestamp.timestamp()) + '|' + title
+        self._pretty_date = None
+        self._read = None  # unknown until the readlist is checked
+
+    @property
+    def pretty_date(self):
+        """ The timestamp formatted for display, only formatted when used """
+        if self._pretty_date is None:
+            self._pretty_date = self.timestamp.strftime('%a, %d %b %Y %H:%M:%S %z')
+        return self._pretty_date
+
+    @classmethod
+    def from_record(cls, record):
+        """ Create an Entry from a record made by 'to_record' """
+        title, posix_time, utc_offset, body, feed_name = record
+        if utc_offset is None:
+            timestamp = datetime.datetime.fromtimestamp(posix_time)
+        else:
+            tzinfo = datetime.timezone(datetime.timedelta(seconds=utc_offset))
+            timestamp = datetime.datetime.fromtimestamp(posix_time, tzinfo)
+        return cls(title, timestamp, body, feed_name)
+
+    def to_record(self):
+        """ Return this entry as a tuple of plain values that can be cached """
+        utc_offset = self.timestamp.utcoffset()
+        if utc_offset is not None:
+            utc_offset = utc_offset.total_seconds()
+        return (self.title, self.timestamp.timestamp(), utc_offset, self.body, self.feed_name)
 
     def has_been_read(self):
-        """ Check if this entry has been read and return True or False. """
-        readlist = InformantConfig().readlist
-        #ui.debug_print('readlist: {}'.format(readlist))
-        title = self.title
-        date = self.timestamp
-        if str(date.timestamp()) + '|' + title in readlist:
-            return True
-        return False
+        """ Check if this entry has been read and return True or False. The
+        readlist is only checked the first time. """
+        if self._read is None:
+            readlist = InformantConfig().readlist
+            #ui.debug_print('readlist: {}'.format(readlist))
+            trace.count('readlist.lookups')
+            self._read = self.read_key in readlist
+        return self._read
 
     def mark_as_read(self):
         """ Save this entry to mark it as read. """
-        readlist = InformantConfig().readlist
         if self.has_been_read():
             return
-        title = self.title
-        date = self.timestamp
-        readlist.append(str(date.timestamp()) + '|' + title)
+        InformantConfig().readlist.add(self.read_key)
+        self._read = True
+
+def resolve_read(entries):
+    """ Look up whether each of 'entries' has been read in one pass, so that
+    has_been_read() doesn't have to check the readlist for them one by one. """
+    readlist = InformantConfig().readlist
+    unresolved = [entry for entry in entries if entry._read is None]
+    trace.count('readlist.lookups', len(unresolved))
+    for entry in unresolved:
+        entry._read = entry.read_key in readlist
+
+def mark_all_as_read(entries):
+    """ Mark all of 'entries' as read, adding them to the readlist in one
+    batch. """
+    InformantConfig().readlist.update(entry.read_key for entry in entries)
+    for entry in entries:
+        entry._read = True
+
 
+def iter_unread(entries, read_streak=0):
+    """ Yield the entries that haven't been read. If 'read_streak' is more than
+    0, stop once that many read entries in a row have been seen: with 'entries'
+    going from newest to oldest it's very unlikely that anything older hasn't
+    been read. """
+    streak = 0
+    for entry in entries:
+        if entry.has_been_read():
+            streak += 1
+            if read_streak and streak >= read_streak:
+                ui.debug_print('stopping after {:d} read items in a row'.format(streak))
+                return
+        else:
+            streak = 0
+            yield entry
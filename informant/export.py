@@ -0,0 +1,67 @@
+"""
+informant/export.py
+
+This module reads and writes export files: a snapshot of the feeds together
+with which of their items have been read, as gzipped JSON. A host that can
+fetch the feeds exports one and hosts without a network (chroots, containers)
+import it, after which they can run 'check' from the snapshot.
+"""
+
+import gzip
+import json
+import sys
+import zlib
+
+from informant.entry import Entry
+
+EXPORT_FORMAT = 'informant-export'
+EXPORT_VERSION = 1
+
+def make_export(snapshot, readlist):
+    """ Return the export of 'snapshot' with the keys in 'readlist' of the
+    items in it that have been read """
+    read_keys = []
+    for feed in snapshot['feeds']:
+        for record in feed['entries']:
+            key = Entry.from_record(record).read_key
+            if key in readlist:
+                read_keys.append(key)
+    return {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'time': snapshot['time'],
+        'feeds': snapshot['feeds'],
+        'read': read_keys,
+    }
+
+def write_export(filename, export):
+    """ Write 'export' to 'filename', or to stdout if it is '-' """
+    data = gzip.compress(json.dumps(export, separators=(',', ':')).encode('utf-8'), mtime=0)
+    if filename == '-':
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+        return
+    with open(filename, 'wb') as export_file:
+        export_file.write(data)
+
+def read_export(filename):
+    """ Return the export in 'filename', or from stdin if it is '-'. Raises
+    ValueError if it isn't an export this version of informant can read. """
+    if filename == '-':
+        data = sys.stdin.buffer.read()
+    else:
+        with open(filename, 'rb') as export_file:
+            data = export_file.read()
+    try:
+        export = json.loads(gzip.decompress(data).decode('utf-8'))
+    except (OSError, EOFError, zlib.error, UnicodeDecodeError) as e:
+        raise ValueError('not an informant export: {}'.format(e))
+    if not isinstance(export, dict) or export.get('format') != EXPORT_FORMAT:
+        raise ValueError('not an informant export')
+    if export.get('version') != EXPORT_VERSION:
+        raise ValueError('unsupported export version {}'.format(export.get('version')))
+    return export
+
+def get_snapshot(export):
+    """ Return the snapshot in 'export' """
+    return {'time': export['time'], 'feeds': export['feeds']}
@@ -4,25 +4,27 @@ informant/feed.py
 This module defines the structure of a newsfeed for Informant.
 """
 
-import os
+import hashlib
+import heapq
+import json
+import queue
 import sys
-
-import requests
-import feedparser
-from dateutil import parser as date_parser
-from cachecontrol import CacheControl
-from cachecontrol.caches import FileCache
+import threading
+import time
 from urllib.error import URLError
 
-from informant.config import InformantConfig
+from informant.config import ARCH_NEWS, InformantConfig
 from informant.entry import Entry
 import informant.file as fs
+from informant.timestamp import TimestampParser
+import informant.trace as trace
+import informant.transport as transport
 import informant.ui as ui
 
-ARCH_NEWS = 'https://archlinux.org/feeds/news/'
+ENTRIES_VERSION = 2 # bumped when entries are built differently, e.g. timestamps
 
 class Feed:
-    def __init__(self, config={}):
+    def __init__(self, config={}, offline=False, entries=None):
         if 'name' in config:
             self.name = config['name']
         else:
@@ -48,46 +50,142 @@ class Feed:
         else:
             self.timestamp_key = 'published'
 
-        ui.debug_print('building feed for: {}'.format(self.name if self.name is not None else self.url))
+        if 'timeout' in config:
+            self.timeout = config['timeout']
+        else:
+            self.timeout = InformantConfig().get_timeout()
+        if isinstance(self.timeout, list):
+            self.timeout = tuple(self.timeout)
+
+        if 'max-items' in config:
+            self.max_items = config['max-items']
+        else:
+            self.max_items = None
+
+        if 'max-body-bytes' in config:
+            self.max_body_bytes = config['max-body-bytes']
+        else:
+            self.max_body_bytes = None
+
+        if 'cache-ttl' in config:
+            self.cache_ttl = config['cache-ttl']
+        else:
+            self.cache_ttl = None
 
-        self.feed = self.fetch()  # the complete feed as returned by feedparser
-        self.entries = self.build_feed()  # the list of entries informant will use
+        if entries is None:
+            ui.debug_print('building feed for: {}'.format(self.name if self.name is not None else self.url))
+
+        self.feed = None  # the complete feed as returned by feedparser, if it was parsed
+        self.failed = False  # True if the feed could not be fetched or parsed
+        self.cache_hit = None  # True if fetching found the cached entries still valid
+        self.downloaded = 0  # bytes downloaded when fetching
+        self.validated = None  # the time fetching confirmed the entries with the server
+        self.fetch_time = None  # seconds the request took, if one was made
+        self.not_modified = False  # True if the server said the feed hasn't changed
+        if entries is not None:
+            self.entries = entries  # e.g. from a snapshot
+        elif offline:
+            self.entries = self.load_cached()
+        else:
+            self.entries = self.fetch()  # the list of entries informant will use
+        # newest first, so feeds can be merged without sorting them all again
+        self.entries.sort(key=lambda k: k.timestamp, reverse=True)
 
     def build_feed(self):
         """
         Abstract away any differences in feeds by using the parsed keys and
-        return an informant-friendly list of entries
+        yield informant-friendly entries
         """
-        entries = []
-        for item in self.feed.entries:
-            timestamp = date_parser.parse(item[self.timestamp_key])
-            entries.append(Entry(item[self.title_key],
-                                 timestamp,
-                                 item[self.body_key],
-                                 self.name))
-        return entries
+        timestamps = TimestampParser()
+        items = self.feed.entries
+        if self.max_items is not None:
+            items = items[:self.max_items]
+        for item in items:
+            with trace.span('timestamp'):
+                timestamp = timestamps.parse(item[self.timestamp_key])
+            trace.count('entries_parsed')
+            body = item[self.body_key]
+            if self.max_body_bytes is not None:
+                body = truncate_body(body, self.max_body_bytes)
+            yield Entry(item[self.title_key],
+                        timestamp,
+                        body,
+                        self.name)
+
+    def signature(self):
+        """ Return the settings that change how this feed's entries are built,
+        cached entries built with different settings can't be reused. """
+        return [ENTRIES_VERSION, self.name, self.title_key, self.body_key, self.timestamp_key,
+                self.max_items, self.max_body_bytes]
 
     def fetch(self):
+        """ Fetch the feed and return its entries. If the feed is unchanged
+        since the entries were last built they are loaded from the entry cache
+        instead of parsing the feed again. The request goes through the HTTP
+        cache, so a feed that is still fresh isn't requested at all and a stale
+        one is revalidated with a conditional request. If the feed can't be
+        fetched, or the server answers with an error, the cached entries are
+        used. """
         # TODO: update to check for http 301/302 redirects
+        # imported here so a run that doesn't fetch doesn't pay for them
+        import requests
         feed = None
-        if InformantConfig().get_argv_clear_cache():
-            ui.debug_print('Clearing cache')
-            fs.clear_cachefile()
-        if InformantConfig().get_argv_use_cache():
-            ui.debug_print('Checking cache in {}'.format(InformantConfig().get_cachefile()))
-            cachefile = InformantConfig().get_cachefile()
-            os.umask(0o0002) # unrestrict umask so we can cache with proper permissions
-            try:
-                session = CacheControl(requests.Session(), cache=FileCache(cachefile, filemode=0o0664, dirmode=0o0775))
-                feed = feedparser.parse(session.get(self.url).content)
-            except Exception as e:
-                ui.err_print('Unable to read cache information: {}'.format(e))
-                ui.debug_print('Falling back to fetching feed')
-                feed = feedparser.parse(self.url)
-        else:
-            feed = feedparser.parse(self.url)
+        start = time.monotonic()
+        use_cache = InformantConfig().get_argv_use_cache()
+        cached = self.read_cache() if use_cache else None
+        try:
+            response = None
+            if use_cache:
+                ui.debug_print('Checking cache in {}'.format(InformantConfig().get_cachefile()))
+                # the HTTP cache replaces these with its own validators if it
+                # has the feed, they are only sent as they are if it doesn't
+                headers = get_conditional_headers(cached)
+                try:
+                    response = transport.timed_get(transport.get_cached_session(), self.url, self.max_items, headers=headers, timeout=self.timeout)
+                except requests.exceptions.RequestException:
+                    raise # a network problem, retrying without the cache won't help
+                except Exception as e:
+                    ui.err_print('Unable to read cache information: {}'.format(e))
+                    ui.debug_print('Falling back to fetching feed')
+            if response is None:
+                response = transport.timed_get(transport.get_session(), self.url, self.max_items, timeout=self.timeout)
+            self.fetch_time = time.monotonic() - start
+            if response.status_code == 304 and cached is not None:
+                self.not_modified = True
+                trace.count('entry_cache.hits')
+                self.cache_hit = True
+                self.validated = time.time()
+                return load_records(cached)
+            # an error page isn't news, handle it like any other failed fetch
+            response.raise_for_status()
+            if not getattr(response, 'from_cache', False):
+                self.downloaded = len(response.content)
+                self.validated = time.time()
+            validator = get_validator(response)
+            if cached is not None and cached.get('validator') == validator:
+                ui.debug_print('feed unchanged, using cached entries')
+                trace.count('entry_cache.hits')
+                self.cache_hit = True
+                return load_records(cached)
+            trace.count('entry_cache.misses')
+            self.cache_hit = False
+            import feedparser
+            with trace.span('feedparser'):
+                feed = feedparser.parse(response.content)
+        except requests.exceptions.RequestException as e:
+            if cached is not None:
+                ui.warn_print('News could not be fetched for {}, using the last saved copy'.format(
+                    self.name if self.name is not None else self.url))
+                ui.debug_print('RequestException: {}'.format(e))
+                self.failed = True
+                return load_records(cached)
+            # report this the same way feedparser reports its own fetch errors
+            import feedparser
+            feed = feedparser.util.FeedParserDict()
+            feed.update({'entries': [], 'bozo': 1, 'bozo_exception': URLError(e)})
 
-        if feed.bozo:
+        self.failed = bool(feed.bozo)
+        if self.failed:
             e = feed.bozo_exception
             if isinstance(e, URLError):
                 # most likely this is an internet issue (no connection)
@@ -108,4 +206,225 @@ class Feed:
                 ui.err_print('Unexpected error: {}'.format(e))
                 sys.exit()
 
-        return feed
+        self.feed = feed
+        try:
+            with trace.span('build_feed'):
+                entries = list(self.build_feed())
+        except KeyError as e:
+            # the feed's items don't have a key the config says to use
+            ui.err_print('Items of {} have no {}, check its title-key, body-key and timestamp-key'.format(
+                self.name if self.name is not None else self.url, e))
+            self.failed = True
+            entries = []
+        if use_cache and not self.failed:
+            fs.save_entry_cache(self.url, {
+                'signature': self.signature(),
+                'saved': time.time(),
+                'validator': validator,
+                'etag': response.headers.get('ETag'),
+                'last-modified': response.headers.get('Last-Modified'),
+                'entries': [entry.to_record() for entry in entries]
+            })
+        return entries
+
+    def read_cache(self):
+        """ Return this feed's entry cache, or None if there isn't one that
+        was built with the current settings and is younger than 'cache-ttl'. """
+        cached = fs.read_entry_cache(self.url)
+        if cached is not None and cached.get('signature') != self.signature():
+            ui.debug_print('feed settings changed, not using cached entries')
+            return None
+        if cached is not None and self.cache_ttl is not None and time.time() - cached.get('saved', 0) > self.cache_ttl:
+            ui.debug_print('cached entries are older than cache-ttl, not using them')
+            return None
+        return cached
+
+    def load_cached(self):
+        """ Return this feed's entries from the entry cache without using the
+        network, for a feed that can't be fetched. If there aren't any the feed
+        is skipped with a warning. """
+        cached = None
+        if InformantConfig().get_argv_use_cache():
+            cached = self.read_cache()
+        if cached is None:
+            ui.warn_print('There is no saved copy of {}, skipping it'.format(self.name if self.name is not None else self.url))
+            return []
+        ui.warn_print('Using the last saved copy of {}'.format(self.name if self.name is not None else self.url))
+        return load_records(cached)
+
+    def debug_fetched(self):
+        """ Print how long fetching took. Feeds are fetched in parallel, this
+        is called from the thread collecting them so the lines don't run
+        together. """
+        if self.fetch_time is None:
+            return
+        ui.debug_print('fetched {} in {:.3f}s{}'.format(self.name if self.name is not None else self.url,
+                                                        self.fetch_time, ', not modified' if self.not_modified else ''))
+
+    def get_id(self):
+        """ Return what identifies this feed in a snapshot """
+        return [self.url] + self.signature()
+
+def load_records(cached):
+    """ Return the entries saved in the entry cache 'cached' """
+    with trace.span('entry_cache.load'):
+        return [Entry.from_record(record) for record in cached['entries']]
+
+def truncate_body(body, max_bytes):
+    """ Return 'body' cut down to at most 'max_bytes' bytes of UTF-8 """
+    encoded = body.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return body
+    trace.count('bodies_truncated')
+    return encoded[:max_bytes].decode('utf-8', errors='ignore') + ' [...]'
+
+def get_conditional_headers(cached):
+    """ Return the headers to make a conditional request for the version of
+    the feed the 'cached' entries were built from. """
+    headers = {}
+    if cached is None:
+        return headers
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last-modified'):
+        headers['If-Modified-Since'] = cached['last-modified']
+    return headers
+
+def get_validator(response):
+    """ Return a string identifying the version of the feed in 'response',
+    using the headers the server gives us if possible so that the body
+    doesn't need to be hashed. """
+    etag = response.headers.get('ETag')
+    if etag:
+        return 'etag:' + etag
+    last_modified = response.headers.get('Last-Modified')
+    if last_modified:
+        return 'last-modified:' + last_modified
+    return 'sha1:' + hashlib.sha1(response.content).hexdigest()
+
+def merge_feeds(feeds):
+    """ Return an iterator over the entries of all 'feeds', newest first. The
+    entries of each feed are already sorted so they only need merging. """
+    return heapq.merge(*[fetched.entries for fetched in feeds],
+                       key=lambda k: k.timestamp, reverse=True)
+
+def load_cached_feeds(feed_configs):
+    """ Return a Feed for each config in 'feed_configs' with the entries saved
+    by its last fetch, without using the network or warning about feeds that
+    have none saved. With --no-cache they have no entries. """
+    use_cache = InformantConfig().get_argv_use_cache()
+    feeds = []
+    for feed_config in feed_configs:
+        cached_feed = Feed(feed_config, entries=[])
+        cached = cached_feed.read_cache() if use_cache else None
+        if cached is not None:
+            cached_feed.entries = load_records(cached)
+            cached_feed.entries.sort(key=lambda k: k.timestamp, reverse=True)
+        feeds.append(cached_feed)
+    return feeds
+
+def fetch_feeds(feed_configs, max_parallel, budget=None):
+    """ Build a Feed for each config in 'feed_configs', fetching up to
+    'max_parallel' of them at once. The Feeds are returned in config order.
+    A feed that fails to fetch is still handled by its own bozo handling, so
+    one bad feed does not hold up the others.
+
+    If 'budget' is given it is the number of seconds to wait for all of the
+    feeds, any feed not done by then uses its cached entries instead.
+    """
+    jobs = queue.Queue()
+    for index, feed_config in enumerate(feed_configs):
+        jobs.put((index, feed_config))
+    finished = queue.Queue()  # the indexes of the feeds the workers are done with
+    results = [None] * len(feed_configs)
+
+    def worker():
+        while True:
+            try:
+                index, feed_config = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = Feed(feed_config)
+            except BaseException as e:
+                # re-raised from the main thread below
+                results[index] = e
+            finished.put(index)
+
+    workers = [threading.Thread(target=worker, daemon=True)
+               for _ in range(min(max_parallel, len(feed_configs)))]
+    for thread in workers:
+        thread.start()
+    deadline = None if budget is None else time.monotonic() + budget
+    for _ in feed_configs:
+        try:
+            if deadline is None:
+                index = finished.get()
+            else:
+                # workers are daemon threads, any still running are abandoned
+                index = finished.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if isinstance(results[index], Feed):
+            results[index].debug_fetched()
+    while not jobs.empty():
+        # don't let abandoned workers start on feeds we no longer wait for
+        try:
+            jobs.get_nowait()
+        except queue.Empty:
+            break
+
+    # take a copy so late workers can't change the results from here on
+    results = list(results)
+    if None in results:
+        ui.warn_print('Ran out of time fetching feeds after {}s'.format(budget))
+    for index, result in enumerate(results):
+        if isinstance(result, BaseException):
+            raise result
+        if result is None:
+            results[index] = Feed(feed_configs[index], offline=True)
+    return results
+
+def save_snapshot(feeds):
+    """ Publish the entries of 'feeds' as a snapshot that can be read without
+    fetching anything. """
+    fs.save_snapshot(make_snapshot(feeds))
+
+def make_snapshot(feeds):
+    """ Return a snapshot of the entries of 'feeds'. A feed that failed to
+    fetch keeps its cached entries. """
+    snapshot = {'time': time.time(), 'feeds': []}
+    for fetched in feeds:
+        records = [entry.to_record() for entry in fetched.entries]
+        if fetched.failed:
+            cached = fetched.read_cache()
+            if cached is not None:
+                records = cached['entries']
+        snapshot['feeds'].append({'id': fetched.get_id(), 'entries': records})
+    return snapshot
+
+def load_snapshot(feed_configs, max_age=None):
+    """ Return Feeds for 'feed_configs' built from the snapshot, or None if
+    there is no snapshot, it doesn't have every feed or it is more than
+    'max_age' seconds old. """
+    snapshot = fs.read_snapshot()
+    if snapshot is None:
+        return None
+    age = time.time() - snapshot['time']
+    ui.debug_print('snapshot is {:.0f}s old'.format(age))
+    if max_age is not None and age > max_age:
+        ui.debug_print('snapshot is older than {}s, not using it'.format(max_age))
+        return None
+    by_id = {json.dumps(feed['id']): feed['entries'] for feed in snapshot['feeds']}
+    feeds = []
+    for feed_config in feed_configs:
+        feed = Feed(feed_config, entries=[])
+        records = by_id.get(json.dumps(feed.get_id()))
+        if records is None:
+            ui.debug_print('snapshot has no entries for {}, not using it'.format(feed.name if feed.name is not None else feed.url))
+            return None
+        with trace.span('snapshot.load'):
+            feed.entries = [Entry.from_record(record) for record in records]
+        feed.entries.sort(key=lambda k: k.timestamp, reverse=True)
+        feeds.append(feed)
+    return feeds
@@ -5,33 +5,63 @@ This module contains filesystem related functions.
 """
 
 import glob
+import gzip
+import hashlib
+import json
 import os
-import pickle
 import shutil
 import sys
+import tempfile
+import time
+import zlib
 
+import informant.client as client
 from informant.config import InformantConfig
+from informant.lock import LockTimeout
+from informant.readlist import Readlist, load as load_readlist
+import informant.trace as trace
 import informant.ui as ui
 
+GZIP_MAGIC = b'\x1f\x8b'
+
 def read_datfile():
-    """ Return the saved readlist from the datfile """
+    """ Return the saved readlist from the readlist server if it is running,
+    else from the datfile """
+    connection = client.connect()
+    if connection is not None:
+        ui.debug_print('Getting readlist from the server at "{}"'.format(InformantConfig().get_socket()))
+        if InformantConfig().get_argv_clear_savefile():
+            return client.RemoteReadlist(connection, clear=True)
+        start = time.monotonic()
+        try:
+            readlist = client.load_readlist(connection)
+        except client.ServerError as e:
+            ui.warn_print('{}, using the save file'.format(e))
+        else:
+            readlist.load_time = time.monotonic() - start
+            ui.debug_print('loaded {:d} read items in {:.3f}s'.format(len(readlist), readlist.load_time))
+            return readlist
     filename = InformantConfig().get_savefile()
     ui.debug_print('Getting datfile from "{}"'.format(filename))
     if InformantConfig().get_argv_clear_savefile():
         ui.debug_print('Clear savefile specified returning empty list')
-        return []
+        return Readlist(clear=True)
+    start = time.monotonic()
     try:
-        with open(filename, 'rb') as pickle_file:
-            try:
-                readlist = pickle.load(pickle_file)
-                pickle_file.close()
-                if isinstance(readlist, tuple):
-                    # backwards compatibility with informant < 0.4.0 save data
-                    readlist = readlist[1]
-            except (EOFError, ValueError):
-                readlist = []
+        with trace.span('readlist.load'):
+            readlist = load_readlist(filename)
     except (FileNotFoundError, PermissionError):
-        readlist = []
+        readlist = Readlist()
+    readlist.load_time = time.monotonic() - start
+    ui.debug_print('loaded {:d} read items in {:.3f}s'.format(len(readlist), readlist.load_time))
+    if readlist.rewrite:
+        ui.debug_print('readlist will be converted to the log format when saved')
+    elif readlist.needs_checkpoint() and os.access(os.path.dirname(os.path.abspath(filename)), os.W_OK):
+        # a checkpoint replaces the file, which we can't do without being able
+        # to write its directory, e.g. for the readlist 'informant serve' keeps
+        ui.debug_print('readlist log has {:d} lines for {:d} items, it will be checkpointed when saved'.format(
+            readlist.log_lines, len(readlist)))
+        readlist.rewrite = True
     return readlist
 
 def save_datfile():
@@ -40,17 +70,178 @@ def save_datfile():
     readlist = InformantConfig().readlist
     if debug:
         ui.debug_print('running in debug mode, will not update readlist')
+        if readlist.rewrite:
+            ui.debug_print('would rewrite the readlist with {:d} items ({:d} removed)'.format(
+                len(readlist), len(readlist.removed)))
+        else:
+            ui.debug_print('would append {:d} items to the readlist:'.format(len(readlist.pending)))
+            for key in readlist.pending:
+                ui.debug_print('    {}'.format(key))
         return
     filename = InformantConfig().get_savefile()
     try:
-        # then open as write to save updated list
-        with open(filename, 'wb') as pickle_file:
-            pickle.dump(readlist, pickle_file)
-            pickle_file.close()
+        with trace.span('readlist.save'):
+            readlist.save(filename)
+    except (LockTimeout, client.ServerError) as e:
+        ui.warn_print('Unable to save read information, {}'.format(e))
+        return
     except PermissionError:
         ui.err_print('Unable to save read information, please re-run with \
 correct permissions to access "{}".'.format(filename))
         sys.exit(255) # this should never block pacman because the hook should run with root/sudo
+    if readlist.lock_wait:
+        trace.record('readlist.lock_wait', time.perf_counter() - readlist.lock_wait, readlist.lock_wait)
+        ui.debug_print('waited {:.3f}s for the readlist lock'.format(readlist.lock_wait))
+
+def makedirs(dirname, mode=0o0775):
+    """ Create 'dirname' and any missing parents with 'mode' regardless of the
+    umask, so that the cache can be shared by root and other users """
+    if os.path.isdir(dirname):
+        return
+    makedirs(os.path.dirname(dirname), mode)
+    try:
+        os.mkdir(dirname)
+    except FileExistsError:
+        return
+    os.chmod(dirname, mode)
+
+def write_atomic(filename, data, mode=0o0664):
+    """ Write the bytes 'data' to 'filename' through a temporary file that is
+    renamed over it, so that a reader sees either the old or the new content
+    and never a partly written file """
+    dirname = os.path.dirname(filename)
+    makedirs(dirname)
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_filename, mode)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+def pack(data):
+    """ Return the bytes 'data' as they should be stored in the cache,
+    compressed if 'cache-compress' is set """
+    if InformantConfig().get_cache_compress():
+        return gzip.compress(data, mtime=0)
+    return data
+
+def unpack(data):
+    """ Return the bytes 'data' read from the cache, decompressed if they were
+    stored compressed (none of the uncompressed formats can start with the
+    gzip magic number) """
+    if data.startswith(GZIP_MAGIC):
+        try:
+            return gzip.decompress(data)
+        except (EOFError, zlib.error) as e:
+            raise ValueError('corrupt compressed cache file') from e
+    return data
+
+def dump_json(value):
+    """ Return 'value' as JSON bytes. Cache files are JSON since the cache
+    directory is shared and root reads it, so loading one must never be able
+    to run code. """
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def load_json(data):
+    """ Return the value of the JSON bytes 'data', raises ValueError if they
+    aren't JSON (e.g. a cache file saved by an older version) """
+    return json.loads(data.decode('utf-8'))
+
+def mark_used(filename):
+    """ Set the access time of the cache file 'filename' to now, keeping its
+    modification time (when it was saved). The cache is evicted by access
+    time, which is kept here because filesystems are often mounted with
+    noatime or relatime. """
+    try:
+        os.utime(filename, ns=(time.time_ns(), os.stat(filename).st_mtime_ns))
+    except OSError:
+        pass # not our file, it won't be evicted quite in order
+
+def get_datfile_size():
+    """ Return the size of the datfile in bytes, 0 if it doesn't exist """
+    try:
+        return os.path.getsize(InformantConfig().get_savefile())
+    except OSError:
+        return 0
+
+def entry_cache_path(url):
+    """ Return the path of the entry cache for the feed at 'url' """
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(InformantConfig().get_cachefile(), 'entries', name)
+
+def read_entry_cache(url):
+    """ Return the cached entries of the feed at 'url' or None if there aren't
+    any """
+    filename = entry_cache_path(url)
+    try:
+        with trace.span('entry_cache.read'), open(filename, 'rb') as cache_file:
+            cached = load_json(unpack(cache_file.read()))
+    except (OSError, ValueError) as e:
+        ui.debug_print('No cached entries for {}: {}'.format(url, e))
+        return None
+    mark_used(filename)
+    return cached
+
+def save_entry_cache(url, cached):
+    """ Save the 'cached' entries of the feed at 'url' """
+    try:
+        with trace.span('entry_cache.save'):
+            write_atomic(entry_cache_path(url), pack(dump_json(cached)))
+    except OSError as e:
+        ui.debug_print('Unable to cache entries for {}: {}'.format(url, e))
+
+def snapshot_path():
+    """ Return the path of the snapshot published by 'informant refresh' """
+    return os.path.join(InformantConfig().get_cachefile(), 'snapshot')
+
+def read_snapshot():
+    """ Return the published snapshot or None if there isn't one, from the
+    readlist server if it is running """
+    connection = client.connect()
+    if connection is not None:
+        try:
+            return connection.request('snapshot')['snapshot']
+        except client.ServerError as e:
+            ui.debug_print('{}, reading the snapshot file'.format(e))
+    try:
+        with trace.span('snapshot.read'), open(snapshot_path(), 'rb') as snapshot_file:
+            return load_json(unpack(snapshot_file.read()))
+    except (OSError, ValueError) as e:
+        ui.debug_print('No snapshot: {}'.format(e))
+        return None
+
+def save_snapshot(snapshot):
+    """ Publish 'snapshot', replacing the old one in a single step so that a
+    reader never sees a partly written snapshot """
+    write_atomic(snapshot_path(), pack(dump_json(snapshot)))
+
+def render_cache_path(key):
+    """ Return the path of the rendered body with the render 'key' """
+    return os.path.join(InformantConfig().get_cachefile(), 'rendered', key)
+
+def read_render_cache(key):
+    """ Return the rendered body saved under 'key' or None if there isn't one """
+    filename = render_cache_path(key)
+    try:
+        with open(filename, 'rb') as render_file:
+            rendered = unpack(render_file.read()).decode('utf-8')
+    except (OSError, ValueError):
+        return None
+    mark_used(filename)
+    return rendered
+
+def save_render_cache(key, rendered):
+    """ Save the 'rendered' body under 'key' """
+    try:
+        write_atomic(render_cache_path(key), pack(rendered.encode('utf-8')))
+    except OSError as e:
+        ui.debug_print('Unable to cache rendered body: {}'.format(e))
 
 def clear_cachefile():
     """ Empty the cachefile directory """
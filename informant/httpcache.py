@@ -0,0 +1,42 @@
+"""
+informant/httpcache.py
+
+This module contains the HTTP cache used by the cached requests session. It is
+imported lazily since it needs cachecontrol.
+"""
+
+import os
+import time
+
+from cachecontrol.caches import FileCache
+from cachecontrol.controller import CacheController
+
+import informant.file as fs
+import informant.lock as lock
+import informant.trace as trace
+
+class AtomicFileCache(FileCache):
+    """ A FileCache that takes a lock on each entry while it is written and
+    writes it to a temporary file that is renamed into place, so that
+    simultaneous informant processes never read a partly written entry or
+    overwrite each other halfway through. Entries are compressed when
+    'cache-compress' is set and marked as used when read, for eviction. """
+
+    def get(self, key):
+        value = super().get(key)
+        if value is None:
+            return None
+        fs.mark_used(self._fn(key))
+        return fs.unpack(value)
+
+    def set(self, key, value, expires=None):
+        filename = self._fn(key)
+        fs.makedirs(os.path.dirname(filename), self.dirmode)
+        with lock.open_locked(filename + '.lock', mode=self.filemode) as (_, waited):
+            fs.write_atomic(filename, fs.pack(value), self.filemode)
+        if waited:
+            trace.record('http_cache.lock_wait', time.perf_counter() - waited, waited)
+
+def cache_path(directory, url):
+    """ Return the path the HTTP cache in 'directory' stores 'url' at """
+    return AtomicFileCache(directory)._fn(CacheController.cache_url(url))
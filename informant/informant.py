@@ -4,8 +4,15 @@ informant - an Arch Linux News reader designed to also be used as a pacman hook
 
 Usage:
     informant [options] check
-    informant [options] list [--reverse --unread]
+    informant [options] list [--reverse --unread --limit=<n>]
     informant [options] read [<item> | --all]
+    informant [options] compact
+    informant [options] refresh [--every=<seconds>]
+    informant [options] cache stats
+    informant [options] search <terms>...
+    informant [options] export <efile>
+    informant [options] import <efile>
+    informant [options] serve
 
 Commands:
     check - Check for unread news items, will exit with a positive return code
@@ -15,15 +22,42 @@ Commands:
 
     list -  Print the most recent news items, regardless of read status. If
             '--reverse' is provided items are printed oldest to newest. If
-            '--unread' is provided only the unread items are returned.
+            '--unread' is provided only the unread items are returned. If
+            '--limit' is provided only the first <n> items are printed.
 
     read  - Read the specified news item, <item> can be either an index or a
-            full title. This will also save the item as 'read' so that future
+            title: the full title, the start of it or one close to it. This
+            will also save the item as 'read' so that future
             calls to 'check' will no longer display it. If no <item> is given,
             will begin looping through all unread items, printing each one and
             marking them as read with a prompt to continue. Passing the --all
             flag will mark all items as read without printing.
 
+    compact - Remove items from the save file that can no longer be returned
+            by any feed: those older than the oldest item the feeds return, or
+            older than 'readlist-max-age' days if that is configured. Reports
+            the size and load time of the save file before and after.
+
+    refresh - Fetch all feeds and save a snapshot of them that 'check' can read
+            without using the network, see 'snapshot-max-age' and '--offline'.
+            This is meant to be run by a timer, or pass '--every' to keep
+            refreshing every <seconds>.
+
+    cache stats - Print the size of the cache and, for each feed, how often
+            its cached copy was still valid, how much was downloaded and
+            stored for it and when it was last validated with the server.
+
+    export - Write the feeds, and which of their items have been read, to
+            <efile> ('-' for stdout) to be imported on hosts without a network.
+
+    import - Read a file written by 'export' (<efile> or '-' for stdin): save
+            its feeds as the snapshot and mark its read items as read.
+
+    serve - Run the readlist server: keep each user's readlist (and the
+            snapshot) and answer other informant processes over a Unix socket,
+            see $INFORMANT_SOCKET. While it runs, other commands use it instead
+            of the save file unless '--file' is given.
+
 Options:
     -c <cfile>, --config=<cfile>    Use <cfile> as the config file
     -d, --debug                     Print the debug messages and don't make
@@ -35,23 +69,38 @@ Options:
     -p <pager>, --pager=<pager>     Use <pager> as the pager to display the
                                     news items
     --no-cache                      Do not use cache
+    --offline                       Do not fetch feeds, read them from the
+                                    snapshot saved by 'refresh' (or from the
+                                    cache if there isn't a usable snapshot)
     --clear-cache                   Empty the cache before fetching feed(s)
     --clear-readlist                Empty the saved readlist
+    --profile                       Print a table of where the time was spent
+                                    when exiting (also printed with --debug)
+    --trace=<tfile>                 Write each timed step to <tfile> as a line
+                                    of JSON
     -h, --help                      Show this help and exit
     -V,--version                    Show version and exit
 
 """
 
 # builtins
+import itertools
 import sys
+import time
 
 # external
 import docopt
 
 # local
-from informant.config import InformantConfig
-from informant.feed import Feed
+import informant.cache as cache
+import informant.client as client
+from informant.config import ConfigError, InformantConfig
+from informant.entry import iter_unread, mark_all_as_read, resolve_read
+from informant.export import get_snapshot, make_export, read_export, write_export
+from informant.feed import Feed, fetch_feeds, load_cached_feeds, load_snapshot, make_snapshot, merge_feeds, save_snapshot
 import informant.file as fs
+import informant.search as search
+import informant.trace as trace
 import informant.ui as ui
 
 __version__ = '0.6.0'
@@ -60,38 +109,51 @@ __version__ = '0.6.0'
 CHECK_CMD = 'check'
 LIST_CMD = 'list'
 READ_CMD = 'read'
+COMPACT_CMD = 'compact'
+REFRESH_CMD = 'refresh'
+CACHE_CMD = 'cache'
+STATS_CMD = 'stats'
+SEARCH_CMD = 'search'
+EXPORT_CMD = 'export'
+IMPORT_CMD = 'import'
+SERVE_CMD = 'serve'
 
 # 'list' options
 REV_OPT = '--reverse'
 UNREAD_OPT = '--unread'
+LIMIT_OPT = '--limit'
 
 # 'read' options and args
 ITEM_ARG = '<item>'
 READALL_OPT = '--all'
 
+# 'refresh' options
+EVERY_OPT = '--every'
+
+# 'search' args
+TERMS_ARG = '<terms>'
+
+# 'export' and 'import' args
+EFILE_ARG = '<efile>'
+
 def check_cmd(feed):
     """ Run the check command. Check if there are any news items that are
     unread. If there is only one unread item, print it out and mark it as read.
     Also, exit the program with return code matching the unread count. """
-    running_from_pacman = ui.running_from_pacman()
-    unread = 0
-    unread_items = []
-    for entry in feed:
-        if not entry.has_been_read():
-            unread += 1
-            unread_items.append(entry)
+    unread_items = list(iter_unread(feed, InformantConfig().get_read_streak()))
+    unread = len(unread_items)
     if unread == 1:
-        if running_from_pacman:
+        if ui.running_from_pacman():
             ui.pacman_msg('Stopping upgrade to print news')
         ui.pretty_print_item(unread_items[0])
         unread_items[0].mark_as_read()
         fs.save_datfile()
-        if running_from_pacman:
+        if ui.running_from_pacman():
             ui.pacman_msg('You can re-run your pacman command to complete the upgrade')
     elif unread > 1:
         print('There are {:d} unread news items! Use informant to read \
 them.'.format(unread))
-        if running_from_pacman:
+        if ui.running_from_pacman():
             ui.pacman_msg('Run `informant read` before re-running your pacman command')
     else:
         print('There are no unread news items')
@@ -101,32 +163,33 @@ def list_cmd(feed):
     """ Run the list command. Print out a list of recent news item titles. """
     argv = InformantConfig().get_argv()
     if argv.get(REV_OPT):
-        feed_list = reversed(feed)
+        feed_list = reversed(list(feed))
     else:
         feed_list = feed
-    index = 0
-    for entry in feed_list:
-        if not argv.get(UNREAD_OPT) \
-        or (argv.get(UNREAD_OPT) and not entry.has_been_read()):
-            print(ui.format_list_item(entry, index))
-            index += 1
+    if argv.get(UNREAD_OPT):
+        # stopping after a streak of read items only works newest to oldest
+        read_streak = 0 if argv.get(REV_OPT) else InformantConfig().get_read_streak()
+        feed_list = iter_unread(feed_list, read_streak)
+    limit = argv.get(LIMIT_OPT)
+    if limit is not None:
+        try:
+            limit = max(0, int(limit))
+        except ValueError:
+            ui.err_print('--limit must be a number, not "{}"'.format(limit))
+            sys.exit(255)
+    # only the items that will be printed are formatted
+    entries = list(itertools.islice(feed_list, limit))
+    resolve_read(entries)
+    ui.print_lines(ui.format_list(entries), len(entries))
 
 def read_cmd(feed):
     """ Run the read command. Print news items and mark them as read. """
     argv = InformantConfig().get_argv()
     if argv.get(READALL_OPT):
-        for entry in feed:
-            entry.mark_as_read()
+        mark_all_as_read(feed)
     else:
         if argv[ITEM_ARG]:
-            try:
-                item = int(argv[ITEM_ARG])
-                entry = feed[item]
-            except ValueError:
-                for entry in feed:
-                    if entry.title == item:
-                        break
-                #NOTE: this will read the oldest unread item if no matches are found
+            entry = find_item(feed, argv[ITEM_ARG])
             ui.pretty_print_item(entry)
             entry.mark_as_read()
         else:
@@ -134,10 +197,12 @@ def read_cmd(feed):
             for entry in feed:
                 if not entry.has_been_read():
                     unread_entries.insert(0, entry)
-            for entry in unread_entries:
+            for index, entry in enumerate(unread_entries):
                 ui.pretty_print_item(entry)
                 entry.mark_as_read()
                 if entry is not unread_entries[-1]:
+                    # render the next item while the user reads this one
+                    ui.prefetch_item(unread_entries[index + 1])
                     read_next = ui.prompt_yes_no('Read next item?', 'yes')
                     if read_next in ('n', 'no'):
                         break
@@ -145,35 +210,288 @@ def read_cmd(feed):
                     print('No more unread items')
     fs.save_datfile()
 
+def is_index(item):
+    """ Return True if the <item> argument 'item' is an index """
+    try:
+        int(item)
+    except ValueError:
+        return False
+    return True
+
+def find_item(feed, item):
+    """ Return the entry of 'feed' that the <item> argument 'item' refers to,
+    either by its index or its title. Exits if there isn't exactly one. """
+    try:
+        return feed[int(item)]
+    except ValueError:
+        matches = search.match_title(feed, item)
+    except IndexError:
+        ui.err_print('There is no news item {}, see `informant list`'.format(item))
+        sys.exit(1)
+    if not matches:
+        ui.err_print('No news item title matches "{}"'.format(item))
+        sys.exit(1)
+    if len(matches) > 1:
+        ui.err_print('"{}" matches {:d} news items, use the index or more of the title:'.format(item, len(matches)))
+        for entry in matches:
+            print(ui.format_list_item(entry, feed.index(entry)))
+        sys.exit(1)
+    return matches[0]
+
+def get_saved_feeds(feed_configs):
+    """ Return the Feeds with the entries saved by their last fetch, from the
+    snapshot if none were saved. They are only fetched if neither has any. """
+    feeds = load_cached_feeds(feed_configs)
+    if not any(cached.entries for cached in feeds):
+        feeds = load_snapshot(feed_configs) or fetch_feeds(feed_configs, InformantConfig().get_max_parallel())
+    return feeds
+
+def search_cmd(feed_configs):
+    """ Run the search command. Print the items that match all of <terms> with
+    the index 'read' takes, best match first. The index is updated with the
+    items it doesn't have yet. """
+    entries = list(merge_feeds(get_saved_feeds(feed_configs)))
+    index = search.load_index()
+    added = index.update(entries)
+    ui.debug_print('added {:d} items to the search index'.format(added))
+    search.save_index(index)
+
+    terms = ' '.join(InformantConfig().get_argv()[TERMS_ARG])
+    positions = {entry.read_key: position for position, entry in enumerate(entries)}
+    # best match first, newest first between equally good matches
+    ranked = sorted(index.search(terms), key=lambda k: (-k[1], positions[k[0]]))
+    results = [entries[positions[key]] for key, _ in ranked]
+    if not results:
+        print('No news items match "{}"'.format(terms))
+        sys.exit(1)
+    resolve_read(results)
+    ui.print_lines((ui.format_list_item(entry, positions[entry.read_key]) for entry in results), len(results))
+
+def refresh_cmd(feed_configs):
+    """ Run the refresh command. Fetch all the feeds and publish a snapshot
+    of them, then keep doing so every '--every' seconds if it was given. """
+    every = InformantConfig().get_argv().get(EVERY_OPT)
+    if every is not None:
+        try:
+            every = float(every)
+            if not 0 < every < float('inf'):
+                raise ValueError(every)
+        except ValueError:
+            ui.err_print('--every must be a positive number of seconds, not "{}"'.format(
+                InformantConfig().get_argv().get(EVERY_OPT)))
+            sys.exit(255)
+    while True:
+        feeds = fetch_feeds(feed_configs, InformantConfig().get_max_parallel())
+        maintain_cache(feeds)
+        try:
+            save_snapshot(feeds)
+        except OSError as e:
+            ui.err_print('Unable to save snapshot: {}'.format(e))
+            sys.exit(255)
+        ui.debug_print('saved snapshot of {:d} items'.format(sum(len(fetched.entries) for fetched in feeds)))
+        if every is None:
+            return
+        time.sleep(every)
+
+def export_cmd(feeds):
+    """ Run the export command. Write the entries of 'feeds' and which of them
+    have been read to <efile>. """
+    filename = InformantConfig().get_argv()[EFILE_ARG]
+    export = make_export(make_snapshot(feeds), InformantConfig().readlist)
+    try:
+        write_export(filename, export)
+    except OSError as e:
+        ui.err_print('Unable to export to "{}": {}'.format(filename, e))
+        sys.exit(255)
+    count = sum(len(feed['entries']) for feed in export['feeds'])
+    ui.debug_print('exported {:d} items, {:d} of them read'.format(count, len(export['read'])))
+
+def import_cmd():
+    """ Run the import command. Save the feeds in <efile> as the snapshot and
+    add its read items to the readlist. """
+    filename = InformantConfig().get_argv()[EFILE_ARG]
+    try:
+        export = read_export(filename)
+    except (OSError, ValueError) as e:
+        ui.err_print('Unable to import "{}": {}'.format(filename, e))
+        sys.exit(255)
+    try:
+        fs.save_snapshot(get_snapshot(export))
+    except OSError as e:
+        ui.err_print('Unable to save snapshot: {}'.format(e))
+        sys.exit(255)
+    readlist = InformantConfig().readlist
+    count = len(readlist)
+    readlist.update(export['read'])
+    fs.save_datfile()
+    print('Imported {:d} items, marked {:d} more as read'.format(
+        sum(len(feed['entries']) for feed in export['feeds']), len(readlist) - count))
+
+def serve_cmd():
+    """ Run the serve command. Answer readlist and snapshot requests on the
+    socket until stopped. """
+    # imported here so that other commands don't pay for socketserver
+    import informant.server as server
+    try:
+        server.serve(InformantConfig().get_socket(), InformantConfig().get_readlist_dir(),
+                     InformantConfig().get_shared_savefile())
+    except OSError as e:
+        ui.err_print('Unable to run the readlist server: {}'.format(e))
+        sys.exit(255)
+
+def get_feeds(feed_configs):
+    """ Return the Feeds to run a command with. They are fetched unless the
+    snapshot can be used: always with '--offline', or for 'check' when it is
+    newer than 'snapshot-max-age'. """
+    argv = InformantConfig().get_argv()
+    if InformantConfig().get_argv_offline():
+        feeds = load_snapshot(feed_configs)
+        if feeds is None:
+            ui.warn_print('No snapshot of the feeds, run `informant refresh` to save one')
+            feeds = [Feed(feed_config, offline=True) for feed_config in feed_configs]
+        return feeds
+
+    budget = None
+    if argv.get(CHECK_CMD):
+        max_age = InformantConfig().get_snapshot_max_age()
+        if max_age is not None:
+            feeds = load_snapshot(feed_configs, max_age)
+            if feeds is not None:
+                return feeds
+            ui.debug_print('no recent snapshot, fetching feeds')
+        budget = InformantConfig().get_check_budget()
+    return fetch_feeds(feed_configs, InformantConfig().get_max_parallel(), budget)
+
+def maintain_cache(feeds):
+    """ Record how the fetched 'feeds' used the cache and, when something new
+    was cached or it is time to, keep the cache within its limits """
+    if not InformantConfig().get_argv_use_cache() or not any(fetched.cache_hit is not None for fetched in feeds):
+        return
+    if not cache.update_stats(feeds):
+        ui.debug_print('nothing new was cached, not maintaining the cache')
+        return
+    removed = cache.maintain(feeds)
+    ui.debug_print('removed {:d} files from the cache'.format(removed))
+
+def compact_cmd(feeds):
+    """ Run the compact command. Remove read markers that no longer match any
+    feed item and rewrite the save file, reporting its size before and after.
+    """
+    filename = InformantConfig().get_savefile()
+    readlist = InformantConfig().readlist
+    count = len(readlist)
+    size = fs.get_datfile_size()
+    load_time = readlist.load_time
+    removed = compact_readlist(feeds)
+    if InformantConfig().get_argv_debug():
+        print('Would remove {:d} of {:d} read items from "{}"'.format(removed, count, filename))
+        return
+    fs.save_datfile()
+    InformantConfig().readlist = fs.read_datfile()
+    if isinstance(readlist, client.RemoteReadlist):
+        print('Removed {:d} of {:d} read items kept by the readlist server'.format(removed, count))
+        return
+    print('Removed {:d} of {:d} read items from "{}"'.format(removed, count, filename))
+    print('size: {:d} -> {:d} bytes, load time: {:.1f} -> {:.1f} ms'.format(
+        size, fs.get_datfile_size(),
+        load_time * 1000, InformantConfig().readlist.load_time * 1000))
+
+def compact_readlist(feeds):
+    """ Remove read markers that can no longer match an item returned by
+    'feeds' from the readlist and return how many were removed. Markers are
+    old enough to remove when they are older than the oldest item any feed
+    returns (only known if every feed returned items) or, if configured, older
+    than 'readlist-max-age' days. Markers for items that are still returned
+    are always kept. """
+    entries = [entry for fetched in feeds for entry in fetched.entries]
+    cutoffs = []
+    if entries and all(fetched.entries for fetched in feeds):
+        cutoffs.append(min(entry.timestamp.timestamp() for entry in entries))
+    max_age = InformantConfig().get_readlist_max_age()
+    if max_age is not None:
+        cutoffs.append(time.time() - max_age * 24 * 60 * 60)
+    if not cutoffs:
+        ui.debug_print('not all feeds were fetched, not compacting readlist')
+        return 0
+    keep = {entry.read_key for entry in entries}
+    removed = InformantConfig().readlist.prune(max(cutoffs), keep)
+    ui.debug_print('compacting readlist removed {:d} items'.format(removed))
+    return removed
+
 def main():
     """ The main function.
     Check given arguments get feed and run given command. """
     argv = docopt.docopt(__doc__, version='informant v{}'.format(__version__))
     InformantConfig().set_argv(argv)
+    try:
+        trace.enable(InformantConfig().get_argv_profile(), InformantConfig().get_argv_trace())
+    except OSError as e:
+        ui.err_print('Unable to write trace file: {}'.format(e))
+        sys.exit(255)
     InformantConfig().debug_print = ui.debug_print
-    InformantConfig().readlist = fs.read_datfile()
-    config = InformantConfig().get_config()
+    try:
+        InformantConfig().get_config()
+    except ConfigError as e:
+        ui.err_print(str(e))
+        sys.exit(255)
+    for message in InformantConfig().config_warnings:
+        ui.warn_print(message)
+    for message in InformantConfig().config_errors:
+        ui.err_print(message)
     ui.debug_print('cli args: {}'.format(argv))
 
-    if 'feeds' in config:
-        feed = []
-        for config_feed in config['feeds']:
-            feed += Feed(config_feed).entries
-    else:
-        feed = Feed().entries
+    if argv.get(SERVE_CMD):
+        serve_cmd()
+        sys.exit()
+    InformantConfig().readlist = fs.read_datfile()
+
+    if InformantConfig().get_argv_clear_cache():
+        ui.debug_print('Clearing cache')
+        fs.clear_cachefile()
+
+    feed_configs = InformantConfig().get_feeds()
+    if argv.get(CACHE_CMD) and argv.get(STATS_CMD):
+        cache.print_stats(feed_configs)
+        sys.exit()
+    if argv.get(REFRESH_CMD):
+        refresh_cmd(feed_configs)
+        sys.exit()
+    if argv.get(SEARCH_CMD):
+        search_cmd(feed_configs)
+        sys.exit()
+    if argv.get(IMPORT_CMD):
+        import_cmd()
+        sys.exit()
+    if argv.get(READ_CMD) and argv[ITEM_ARG] and not is_index(argv[ITEM_ARG]):
+        # a title is looked up in the saved feeds instead of fetching them,
+        # an index has to match what `informant list` shows now
+        read_cmd(list(merge_feeds(get_saved_feeds(feed_configs))))
+        sys.exit()
+    feeds = get_feeds(feed_configs)
+    maintain_cache(feeds)
+
+    if argv.get(COMPACT_CMD):
+        compact_cmd(feeds)
+        sys.exit()
+    if argv.get(EXPORT_CMD):
+        export_cmd(feeds)
+        sys.exit()
+    if InformantConfig().get_auto_compact():
+        # the next command that saves the readlist will write the result
+        compact_readlist(feeds)
 
-    if not feed:
+    if not any(fetched.entries for fetched in feeds):
         ui.warn_print('no news feed items, informant is performing no action')
         sys.exit()
 
-    feed = sorted(feed, key=lambda k: k.timestamp, reverse=True)
+    feed = merge_feeds(feeds)
 
     if argv.get(CHECK_CMD):
         check_cmd(feed)
     elif argv.get(LIST_CMD):
         list_cmd(feed)
     elif argv.get(READ_CMD):
-        read_cmd(feed)
+        read_cmd(list(feed))
     sys.exit()
 
 if __name__ == '__main__':
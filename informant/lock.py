@@ -0,0 +1,59 @@
+"""
+informant/lock.py
+
+This module contains file locking helpers so that informant processes running
+at the same time (e.g. a pacman hook and a user's `informant read`) don't
+overwrite each other's changes.
+"""
+
+import contextlib
+import fcntl
+import os
+import time
+
+LOCK_TIMEOUT = 10 # seconds to wait for another process to release a lock
+LOCK_POLL = 0.05 # seconds between attempts to take a lock
+
+class LockTimeout(OSError):
+    """ Raised when a lock could not be taken within the timeout """
+
+@contextlib.contextmanager
+def open_locked(filename, timeout=LOCK_TIMEOUT, mode=None):
+    """ Open 'filename' for reading and appending (creating it if needed, with
+    'mode' regardless of the umask if given) with an exclusive lock, yielding
+    the file and the seconds spent waiting for another process to release the
+    lock (0.0 if it wasn't held). A file that is
+    replaced by renaming over it while we wait is reopened, so the lock is
+    always on the file currently at 'filename'. """
+    start = time.monotonic()
+    contended = False
+    while True:
+        locked_file = open(filename, 'a+b')
+        try:
+            if mode is not None and os.fstat(locked_file.fileno()).st_uid == os.geteuid():
+                os.fchmod(locked_file.fileno(), mode)
+            while True:
+                try:
+                    fcntl.flock(locked_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    contended = True
+                    if time.monotonic() - start > timeout:
+                        raise LockTimeout('timed out waiting for a lock on "{}"'.format(filename))
+                    time.sleep(LOCK_POLL)
+            try:
+                current = os.stat(filename).st_ino
+            except FileNotFoundError:
+                current = None
+            if current == os.fstat(locked_file.fileno()).st_ino:
+                break
+        except BaseException:
+            locked_file.close()
+            raise
+        # replaced while we were waiting, lock the new file instead
+        locked_file.close()
+    try:
+        yield locked_file, time.monotonic() - start if contended else 0.0
+    finally:
+        # closing the file releases the lock
+        locked_file.close()
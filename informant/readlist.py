@@ -0,0 +1,146 @@
+"""
+informant/readlist.py
+
+This module defines the readlist, the set of news items that have been read,
+and the append-only log it is saved in.
+"""
+
+import json
+import os
+import pickle
+
+import informant.lock as lock
+
+HEADER = 'informant-readlist 1\n'
+CHECKPOINT_MIN = 1000 # redundant log lines tolerated before a checkpoint
+
+class Readlist:
+    """ A set of read item keys that remembers which keys were added since it
+    was loaded, so that saving only has to append those. """
+
+    def __init__(self, keys=(), rewrite=False, clear=False):
+        self.keys = set(keys)
+        self.pending = []  # keys added since the last save
+        self.removed = set()  # keys removed since the last save
+        self.rewrite = rewrite or clear  # True if the whole file has to be written
+        self.clear = clear  # True if keys saved by others should be dropped too
+        self.load_time = 0.0  # seconds it took to load the readlist
+        self.lock_wait = 0.0  # seconds the last save waited for the file lock
+        self.log_lines = 0  # key lines in the saved log, duplicates included
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def add(self, key):
+        """ Add 'key' to the readlist if it isn't already there """
+        if key in self.keys:
+            return
+        self.keys.add(key)
+        self.pending.append(key)
+
+    def update(self, keys):
+        """ Add all of 'keys' that aren't already in the readlist """
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.keys]
+        self.keys.update(new_keys)
+        self.pending.extend(new_keys)
+
+    def prune(self, cutoff, keep=()):
+        """ Remove the keys made from items older than the POSIX time 'cutoff',
+        except those in 'keep', and return how many were removed. """
+        old = set()
+        for key in self.keys:
+            try:
+                if key not in keep and key_time(key) < cutoff:
+                    old.add(key)
+            except ValueError:
+                continue
+        if old:
+            self.keys -= old
+            self.removed |= old
+            self.pending = [key for key in self.pending if key not in old]
+            self.rewrite = True
+        return len(old)
+
+    def needs_checkpoint(self):
+        """ Return True if the saved log has enough redundant lines (keys
+        appended more than once by processes saving at the same time) that it
+        should be folded back into one line per key """
+        redundant = self.log_lines - len(self.keys)
+        return redundant > max(CHECKPOINT_MIN, len(self.keys) // 2)
+
+    def save(self, filename, timeout=lock.LOCK_TIMEOUT):
+        """ Save the readlist to 'filename'. Normally this appends the pending
+        keys to the log, the whole file is only written for a new, migrated or
+        compacted readlist. The file is locked while saving, and a rewrite
+        keeps keys other processes saved since it was loaded. """
+        if not self.rewrite and not self.pending:
+            return
+        with lock.open_locked(filename, timeout) as (log_file, self.lock_wait):
+            if self.rewrite:
+                if not self.clear:
+                    log_file.seek(0)
+                    saved = parse(log_file.read())
+                    self.keys |= saved.keys - self.removed
+                tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+                with open(tmp_filename, 'wb') as tmp_file:
+                    tmp_file.write(HEADER.encode('utf-8'))
+                    tmp_file.write(''.join(json.dumps(key) + '\n' for key in self.keys).encode('utf-8'))
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+                os.chmod(tmp_filename, os.fstat(log_file.fileno()).st_mode & 0o7777)
+                os.replace(tmp_filename, filename)
+                self.log_lines = len(self.keys)
+            else:
+                log_file.seek(0, os.SEEK_END)
+                lines = ''.join(json.dumps(key) + '\n' for key in self.pending)
+                if log_file.tell() == 0:
+                    lines = HEADER + lines
+                # one write so that a reader never sees half of our changes
+                log_file.write(lines.encode('utf-8'))
+                log_file.flush()
+                self.log_lines += len(self.pending)
+        self.pending = []
+        self.removed = set()
+        self.rewrite = False
+        self.clear = False
+
+def key_time(key):
+    """ Return the POSIX time of the item a readlist key was made from """
+    return float(key.split('|', 1)[0])
+
+def load(filename):
+    """ Return the Readlist saved in 'filename'. Older versions of informant
+    saved a pickled list (or tuple for informant < 0.4.0), those are loaded
+    and flagged so the next save converts the file to the log format.
+    """
+    with open(filename, 'rb') as log_file:
+        return parse(log_file.read())
+
+def parse(data):
+    """ Return the Readlist saved in the bytes 'data' """
+    if not data:
+        return Readlist()
+    if not data.startswith(HEADER.encode('utf-8')):
+        try:
+            readlist = pickle.loads(data)
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            return Readlist(rewrite=True)
+        if isinstance(readlist, tuple):
+            # backwards compatibility with informant < 0.4.0 save data
+            readlist = readlist[1]
+        return Readlist(readlist, rewrite=True)
+    readlist = Readlist()
+    for line in data.decode('utf-8', errors='replace').splitlines()[1:]:
+        try:
+            readlist.keys.add(json.loads(line))
+        except ValueError:
+            # most likely a write that was interrupted, skip it
+            continue
+        readlist.log_lines += 1
+    return readlist
@@ -0,0 +1,159 @@
+"""
+informant/search.py
+
+This module contains the search index: the words of each news item's title,
+feed name and rendered body, saved in the cache directory. It is updated from
+the entries informant already has, so only new items have to be rendered.
+"""
+
+import bisect
+import difflib
+import os
+import re
+
+from informant.config import InformantConfig
+import informant.file as fs
+import informant.trace as trace
+import informant.ui as ui
+
+INDEX_VERSION = 2
+INDEX_NAME = 'search'
+TITLE_WEIGHT = 3 # a word found in the title counts this many times more
+FUZZY_CUTOFF = 0.8 # how close a misspelled word must be to be matched
+
+WORD_RE = re.compile(r'\w+')
+
+def tokenize(text):
+    """ Return the set of lower case words in 'text' """
+    return set(WORD_RE.findall(text.lower()))
+
+class SearchIndex:
+    """ An inverted index from words to the read keys of the items they are
+    in. 'docs' holds the title words and other words of each indexed item. """
+
+    def __init__(self):
+        self.docs = {}  # read key -> (title words, feed name and body words)
+        self.terms = {}  # word -> set of read keys
+        self.changed = False
+        self._sorted_terms = None
+
+    def add(self, entry):
+        """ Index 'entry' """
+        title_words = tokenize(entry.title)
+        other_words = tokenize(entry.feed_name or '') | tokenize(ui.format_body(entry.body))
+        self.docs[entry.read_key] = (title_words, other_words)
+        for word in title_words | other_words:
+            self.terms.setdefault(word, set()).add(entry.read_key)
+        self.changed = True
+        self._sorted_terms = None
+
+    def remove(self, key):
+        """ Remove the item with the read key 'key' from the index """
+        title_words, other_words = self.docs.pop(key)
+        for word in title_words | other_words:
+            keys = self.terms[word]
+            keys.discard(key)
+            if not keys:
+                del self.terms[word]
+        self.changed = True
+        self._sorted_terms = None
+
+    def update(self, entries):
+        """ Index the 'entries' that aren't indexed yet and drop the indexed
+        items that are no longer among them. Returns how many were added. """
+        current = {entry.read_key: entry for entry in entries}
+        with trace.span('search.update'):
+            for key in [key for key in self.docs if key not in current]:
+                self.remove(key)
+            new = [entry for key, entry in current.items() if key not in self.docs]
+            for entry in new:
+                self.add(entry)
+        return len(new)
+
+    def expand(self, term):
+        """ Return the indexed words 'term' matches: those it is a prefix of,
+        or if there are none the words it is a likely misspelling of """
+        if self._sorted_terms is None:
+            self._sorted_terms = sorted(self.terms)
+        words = []
+        start = bisect.bisect_left(self._sorted_terms, term)
+        for word in self._sorted_terms[start:]:
+            if not word.startswith(term):
+                break
+            words.append(word)
+        if not words:
+            words = difflib.get_close_matches(term, self._sorted_terms, n=3, cutoff=FUZZY_CUTOFF)
+        return words
+
+    def search(self, query):
+        """ Return the read keys of the items that match every word of 'query'
+        with the score of each, best match first """
+        scores = None
+        with trace.span('search.query'):
+            for term in tokenize(query):
+                term_scores = {}
+                for word in self.expand(term):
+                    for key in self.terms[word]:
+                        weight = TITLE_WEIGHT if word in self.docs[key][0] else 1
+                        term_scores[key] = max(term_scores.get(key, 0), weight)
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {key: score + term_scores[key] for key, score in scores.items() if key in term_scores}
+        if not scores:
+            return []
+        return sorted(scores.items(), key=lambda k: -k[1])
+
+def index_path():
+    """ Return the path of the saved search index """
+    return os.path.join(InformantConfig().get_cachefile(), INDEX_NAME)
+
+def load_index():
+    """ Return the saved search index, or an empty one if there isn't one that
+    was built the same way """
+    try:
+        with trace.span('search.load'), open(index_path(), 'rb') as index_file:
+            saved = fs.load_json(fs.unpack(index_file.read()))
+    except (OSError, ValueError) as e:
+        ui.debug_print('No search index: {}'.format(e))
+        return SearchIndex()
+    if not isinstance(saved, dict) or saved.get('version') != INDEX_VERSION or saved.get('width') != ui.BODY_WIDTH:
+        ui.debug_print('search index was built differently, rebuilding it')
+        return SearchIndex()
+    index = SearchIndex()
+    # only the words of each item are saved, the inverted index is rebuilt
+    for key, (title_words, other_words) in saved['docs'].items():
+        words = index.docs[key] = (set(title_words), set(other_words))
+        for word in words[0] | words[1]:
+            index.terms.setdefault(word, set()).add(key)
+    return index
+
+def save_index(index):
+    """ Save 'index' if it changed since it was loaded """
+    if not index.changed or not InformantConfig().get_argv_use_cache():
+        return
+    docs = {key: [sorted(title_words), sorted(other_words)] for key, (title_words, other_words) in index.docs.items()}
+    saved = {'version': INDEX_VERSION, 'width': ui.BODY_WIDTH, 'docs': docs}
+    try:
+        with trace.span('search.save'):
+            fs.write_atomic(index_path(), fs.pack(fs.dump_json(saved)))
+    except OSError as e:
+        ui.debug_print('Unable to save the search index: {}'.format(e))
+
+def match_title(entries, text):
+    """ Return the 'entries' whose title 'text' refers to: the one with exactly
+    that title, else those whose title starts with it (ignoring case), else the
+    one with the closest title. """
+    folded = text.casefold()
+    titles = {}
+    matches = []
+    for entry in entries:
+        if entry.title == text:
+            return [entry]
+        title = entry.title.casefold()
+        titles.setdefault(title, entry)
+        if title.startswith(folded):
+            matches.append(entry)
+    if matches:
+        return matches
+    return [titles[title] for title in difflib.get_close_matches(folded, titles, n=1)]
@@ -0,0 +1,178 @@
+"""
+informant/server.py
+
+This module contains the readlist server started by `informant serve`. It
+keeps the readlist of each user and the snapshot in memory and answers other
+informant processes over a Unix socket, so every user has their own read state
+without needing permission to write a shared save file. Requests and responses
+are lines of JSON, see informant/client.py for the other end.
+"""
+
+import json
+import os
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+import informant.client as client
+from informant.config import InformantConfig
+import informant.file as fs
+from informant.readlist import Readlist, load as load_readlist
+import informant.ui as ui
+
+PROTOCOL_VERSION = 1
+ROOT_UID = 0
+
+def peer_uid(sock):
+    """ Return the user id of the process at the other end of 'sock' """
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """ Answers the requests of one connected informant process """
+
+    def handle(self):
+        uid = peer_uid(self.request)
+        for line in self.rfile:
+            try:
+                response = self.server.answer(uid, json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'error': 'bad request: {}'.format(e)}
+            except OSError as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class ReadlistServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Keeps a readlist per user, saved as '<uid>.dat' in the readlist
+    directory and owned by that user, so they can still mark items read while
+    the server isn't running. A user without one starts with the keys of
+    'seed_file', the save file used before there was a server. """
+    daemon_threads = True
+
+    def __init__(self, socket_path, seed_file):
+        self.seed_file = seed_file
+        self.readlists = {}  # user id -> Readlist
+        self.snapshot = None
+        self.snapshot_mtime = None
+        self.lock = threading.Lock()
+        super().__init__(socket_path, RequestHandler)
+        # anyone may connect, each request is checked against the peer's uid
+        os.chmod(socket_path, 0o0666)
+
+    def get_readlist(self, uid):
+        """ Return the readlist of the user 'uid', loading it if needed """
+        readlist = self.readlists.get(uid)
+        if readlist is not None:
+            return readlist
+        try:
+            readlist = load_readlist(InformantConfig().get_user_savefile(uid))
+            self.give_savefile(uid)
+        except FileNotFoundError:
+            try:
+                readlist = Readlist(load_readlist(self.seed_file), rewrite=True)
+            except OSError:
+                readlist = Readlist()
+        if readlist.needs_checkpoint():
+            readlist.rewrite = True
+        self.readlists[uid] = readlist
+        return readlist
+
+    def save_readlist(self, uid, readlist):
+        """ Save 'readlist' as the readlist of the user 'uid' """
+        readlist.save(InformantConfig().get_user_savefile(uid))
+        self.give_savefile(uid)
+
+    def give_savefile(self, uid):
+        """ Make the user 'uid' the owner of their save file. Rewriting it
+        replaces the file, so this is needed after every save. """
+        if os.geteuid() != ROOT_UID:
+            return # only root can give files away
+        filename = InformantConfig().get_user_savefile(uid)
+        try:
+            if os.stat(filename).st_uid != uid:
+                os.chown(filename, uid, -1)
+        except FileNotFoundError:
+            pass # nothing was saved yet
+
+    def get_snapshot(self):
+        """ Return the snapshot, reading it again when 'refresh' replaced it """
+        try:
+            mtime = os.stat(fs.snapshot_path()).st_mtime_ns
+        except OSError:
+            return None
+        if mtime != self.snapshot_mtime:
+            self.snapshot = fs.read_snapshot()
+            self.snapshot_mtime = mtime
+        return self.snapshot
+
+    def answer(self, peer, request):
+        """ Return the response to 'request' from a process of the user 'peer'.
+        Only root may use the read state of another user, which is how the
+        pacman hook run through sudo uses that of the user running sudo. """
+        op = request['op']
+        if op == 'hello':
+            return {'version': PROTOCOL_VERSION}
+        if op == 'snapshot':
+            with self.lock:
+                return {'snapshot': self.get_snapshot()}
+        user = request.get('user', peer)
+        if user != peer and peer != ROOT_UID:
+            return {'error': 'user {} may not use the read state of user {}'.format(peer, user)}
+        with self.lock:
+            if op == 'load':
+                return {'keys': list(self.get_readlist(user))}
+            if op == 'add':
+                readlist = self.get_readlist(user)
+                readlist.update(request['keys'])
+                added = len(readlist.pending)
+                self.save_readlist(user, readlist)
+                return {'added': added}
+            if op == 'rewrite':
+                if request.get('clear'):
+                    self.readlists[user] = Readlist(clear=True)
+                readlist = self.get_readlist(user)
+                removed = set(request.get('removed', ()))
+                readlist.keys -= removed
+                readlist.removed |= removed
+                readlist.update(request['keys'])
+                readlist.rewrite = True
+                self.save_readlist(user, readlist)
+                return {'count': len(readlist)}
+        return {'error': 'unknown request "{}"'.format(op)}
+
+def remove_stale_socket(socket_path):
+    """ Remove the socket left at 'socket_path' by a server that is no longer
+    running. Raises OSError if one is still running. """
+    if not os.path.exists(socket_path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except ConnectionRefusedError:
+        os.remove(socket_path)
+        return
+    finally:
+        probe.close()
+    raise OSError('a readlist server is already running at "{}"'.format(socket_path))
+
+def serve(socket_path, directory, seed_file):
+    """ Run the readlist server at 'socket_path' until it is interrupted or
+    terminated """
+    client.disable()
+    remove_stale_socket(socket_path)
+    fs.makedirs(directory, 0o0755)
+    server = ReadlistServer(socket_path, seed_file)
+    # leave serve_forever() through the finally below when systemd stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    ui.debug_print('serving readlists from "{}" at "{}"'.format(directory, socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
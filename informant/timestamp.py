@@ -0,0 +1,76 @@
+"""
+informant/timestamp.py
+
+This module turns the date strings of feed items into datetimes. Most feeds use
+RFC 822 (RSS) or ISO 8601 (Atom) dates, which have fast exact parsers here, the
+slow but forgiving dateutil parser is only used for anything else. Every fast
+path only accepts dates it parses the same way dateutil does, so an item's
+timestamp (and timezone) doesn't depend on which parser was used. The time
+tuples feedparser makes aren't used: it gets several date formats wrong and
+rolls invalid dates over into the next day or month where dateutil rejects them.
+"""
+
+import datetime
+import email.utils
+import re
+
+import informant.trace as trace
+
+RFC822_RE = re.compile(r'(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun), )?\d{1,2} [A-Za-z]{3} [1-9]\d{3} '
+                       r'\d{2}:\d{2}(?::\d{2})? (?:[+-]\d{4}|GMT|UTC)', re.IGNORECASE)
+ISO8601_RE = re.compile(r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d{1,6})?)?'
+                        r'(?:Z|[+-]\d{2}:?\d{2})?')
+
+def from_rfc822(text):
+    """ Parse an RFC 822 date like 'Mon, 01 Sep 2024 10:00:00 +0200' """
+    if not RFC822_RE.fullmatch(text):
+        return None
+    fields = email.utils.parsedate_tz(text)
+    if fields is None:
+        return None
+    try:
+        offset = datetime.timezone(datetime.timedelta(seconds=fields[9] or 0))
+        return datetime.datetime(*fields[:6], tzinfo=offset)
+    except ValueError:
+        return None
+
+def from_iso8601(text):
+    """ Parse an ISO 8601 date like '2024-09-01T10:00:00+02:00' """
+    if not ISO8601_RE.fullmatch(text):
+        return None
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+
+def from_dateutil(text):
+    """ Parse any date dateutil understands """
+    from dateutil import parser as date_parser
+    return date_parser.parse(text)
+
+PARSERS = (from_rfc822, from_iso8601, from_dateutil)
+
+class TimestampParser:
+    """ Parses the dates of one feed. Feeds use the same format for all their
+    items, so the parser that worked for the last item is tried first. """
+
+    def __init__(self):
+        self.learned = None
+
+    def parse(self, text):
+        """ Return the datetime of the date string 'text' """
+        if self.learned is not None:
+            timestamp = self.learned(text)
+            if timestamp is not None:
+                trace.count('timestamp.' + self.learned.__name__)
+                return timestamp
+        for parser in PARSERS:
+            if parser is self.learned:
+                continue
+            timestamp = parser(text)
+            if timestamp is not None:
+                self.learned = parser
+                trace.count('timestamp.' + parser.__name__)
+                return timestamp
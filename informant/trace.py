@@ -0,0 +1,116 @@
+"""
+informant/trace.py
+
+This module contains timing instrumentation: named spans and counters that
+can be printed as a summary table or written as a JSON lines trace. When it
+hasn't been enabled every span is the same no-op object.
+"""
+
+import atexit
+import json
+import sys
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+_start = 0.0
+_spans = {}  # span name -> [count, total seconds, max seconds]
+_counters = {}  # counter name -> value
+_trace_file = None
+
+class _Span:
+    """ Times the block it is used for and records it under 'name' """
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+class _NoSpan:
+    """ Used in place of a _Span when tracing isn't enabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+def span(name):
+    """ Return a context manager that times a block as the span 'name' """
+    if not _enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+def count(name, amount=1):
+    """ Add 'amount' to the counter 'name' """
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def record(name, start, duration):
+    """ Record a span 'name' that started at the perf_counter time 'start' and
+    took 'duration' seconds """
+    if not _enabled:
+        return
+    with _lock:
+        stats = _spans.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+        if _trace_file is not None:
+            _trace_file.write(json.dumps({
+                'span': name,
+                'start': round(start - _start, 6),
+                'duration': round(duration, 6),
+                'thread': threading.current_thread().name
+            }) + '\n')
+
+def enable(summary=False, trace_filename=None):
+    """ Start recording spans and counters. If 'summary' is True a table of
+    them is printed to stderr at exit, if 'trace_filename' is given each span
+    is written to it as a line of JSON. """
+    global _enabled, _start, _trace_file
+    if not summary and trace_filename is None:
+        return
+    _start = time.perf_counter()
+    if trace_filename is not None:
+        _trace_file = open(trace_filename, 'w')
+    _enabled = True
+    atexit.register(finish, summary)
+
+def finish(summary):
+    """ Stop recording, print the summary table and close the trace file """
+    global _enabled, _trace_file
+    _enabled = False
+    if _trace_file is not None:
+        for name, value in sorted(_counters.items()):
+            _trace_file.write(json.dumps({'counter': name, 'value': value}) + '\n')
+        _trace_file.close()
+        _trace_file = None
+    if summary:
+        print_summary()
+
+def print_summary():
+    """ Print the recorded spans and counters as a table to stderr """
+    total = time.perf_counter() - _start
+    print('{:<28} {:>7} {:>11} {:>11} {:>11}'.format('span', 'count', 'total ms', 'mean ms', 'max ms'),
+          file=sys.stderr)
+    for name, (calls, duration, longest) in sorted(_spans.items(), key=lambda k: -k[1][1]):
+        print('{:<28} {:>7d} {:>11.2f} {:>11.3f} {:>11.2f}'.format(
+            name, calls, duration * 1000, duration * 1000 / calls, longest * 1000), file=sys.stderr)
+    for name, value in sorted(_counters.items()):
+        print('{:<28} {:>7d}'.format(name, value), file=sys.stderr)
+    print('{:<28} {:>7} {:>11.2f}'.format('total (wall-clock)', '', total * 1000), file=sys.stderr)
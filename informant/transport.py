@@ -0,0 +1,149 @@
+"""
+informant/transport.py
+
+This module contains the HTTP transport shared by all feeds: pooled keep-alive
+sessions (one plain and one using the HTTP cache) that retry transient errors,
+ask for compressed responses and use the proxies from the config.
+"""
+
+import threading
+import time
+
+from informant.config import InformantConfig
+import informant.trace as trace
+import informant.ui as ui
+
+RETRY_BACKOFF = 0.5 # seconds, doubled for each retry after the first
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def read_items(response, max_items):
+    """ Read the body of the streamed 'response' until 'max_items' feed items
+    (RSS <item> or Atom <entry> elements) have been received and return it,
+    with the elements still open at that point closed so that it is a complete
+    feed. If the body can't be followed as XML it is read completely. """
+    import xml.parsers.expat
+    parser = xml.parsers.expat.ParserCreate()
+    open_elements = []
+    items = 0
+    end = None  # where the last item kept ends
+    closing = ''  # the end tags of the elements still open at 'end'
+
+    def start_element(name, attrs):
+        open_elements.append(name)
+
+    def end_element(name):
+        nonlocal items, end, closing
+        open_elements.pop()
+        if end is None and name.rpartition(':')[2] in ('item', 'entry'):
+            items += 1
+            if items == max_items:
+                end = parser.CurrentByteIndex
+                closing = ''.join('</{}>'.format(open_name) for open_name in reversed(open_elements))
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    content = bytearray()
+    chunks = response.iter_content(chunk_size=16384)
+    for chunk in chunks:
+        content += chunk
+        try:
+            parser.Parse(chunk, False)
+        except xml.parsers.expat.ExpatError as e:
+            ui.debug_print('Unable to stream {}, reading all of it: {}'.format(response.url, e))
+            content += b''.join(chunks)
+            return bytes(content)
+        if end is not None:
+            break
+    if end is None:
+        return bytes(content)
+    response.close()
+    # 'end' is where the item's end tag starts, keep all of the tag and close
+    # the elements that contained it, e.g. </channel></rss>
+    end = content.index(b'>', end) + 1
+    trace.count('streams_stopped')
+    return bytes(content[:end]) + closing.encode('utf-8')
+
+def timed_get(session, url, max_items=None, **kwargs):
+    """ Make a GET request for 'url' with 'session', recording how long the
+    headers and body took and how much was downloaded. With 'max_items' only
+    the start of the feed up to that many items is downloaded. """
+    proxies = InformantConfig().get_proxies()
+    if proxies:
+        # passed with the request so they take precedence over the environment
+        kwargs.setdefault('proxies', proxies)
+    start = time.perf_counter()
+    if max_items is None:
+        response = session.get(url, **kwargs)
+    else:
+        response = session.get(url, stream=True, **kwargs)
+        if response.status_code == 200 and not getattr(response, 'from_cache', False):
+            # set the body as if it had all been read, the rest of informant
+            # sees only the items that were kept. The HTTP cache only stores
+            # bodies read to the end, so a stream stopped early isn't cached
+            # and later runs revalidate it with the entry cache's validators
+            response._content = read_items(response, max_items)
+    duration = time.perf_counter() - start
+    trace.record('http', start, duration)
+    if getattr(response, 'from_cache', False):
+        trace.count('http_cache.hits')
+    else:
+        # 'elapsed' is the time until the headers were parsed
+        headers = response.elapsed.total_seconds()
+        trace.record('http.headers', start, headers)
+        trace.record('http.body', start + headers, max(0.0, duration - headers))
+        trace.count('bytes_downloaded', len(response.content))
+    return response
+
+_session_lock = threading.Lock()
+_session = None
+_cached_session = None
+
+def make_retry():
+    """ Return the retry policy for feed requests. Only GETs are retried, and
+    Retry-After isn't honoured so a server can't stall a pacman hook; once the
+    retries are used up the last response is returned as it is. """
+    from urllib3.util.retry import Retry
+    retries = InformantConfig().get_retries()
+    return Retry(total=retries, connect=retries, read=retries, status=retries,
+                 backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES,
+                 allowed_methods=frozenset(['GET']),
+                 respect_retry_after_header=False, raise_on_status=False)
+
+def configure(session, adapter):
+    """ Mount 'adapter' on 'session' for http and https and set the headers
+    informant sends with every request """
+    from urllib3.util.request import ACCEPT_ENCODING
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # gzip and deflate, and br when a brotli module is installed
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    return session
+
+def get_session():
+    """ Return the requests session shared by all feeds, so that connections
+    to the same host are pooled and reused. """
+    import requests
+    global _session
+    with _session_lock:
+        if _session is None:
+            max_parallel = InformantConfig().get_max_parallel()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max_parallel, pool_maxsize=max_parallel,
+                                                    max_retries=make_retry())
+            _session = configure(requests.Session(), adapter)
+        return _session
+
+def get_cached_session():
+    """ Return the shared requests session that uses the HTTP cache. It is
+    pooled and retries the same way as the plain session. """
+    import requests
+    from cachecontrol.adapter import CacheControlAdapter
+    from informant.httpcache import AtomicFileCache
+    global _cached_session
+    with _session_lock:
+        if _cached_session is None:
+            max_parallel = InformantConfig().get_max_parallel()
+            cache = AtomicFileCache(InformantConfig().get_cachefile(), filemode=0o0664, dirmode=0o0775)
+            adapter = CacheControlAdapter(cache=cache, pool_connections=max_parallel, pool_maxsize=max_parallel,
+                                          max_retries=make_retry())
+            _cached_session = configure(requests.Session(), adapter)
+        return _cached_session
@@ -4,17 +4,26 @@ informant/ui.py
 This module contains User Interface related functions.
 """
 
+import functools
+import hashlib
 import os
 import shutil
+import subprocess
 import sys
 import textwrap
-
-import html2text
-import psutil
+import threading
 
 from informant.config import PAGER_DEFAULT, InformantConfig
+import informant.trace as trace
 
 RAW_OPT = '--raw'
+BODY_WIDTH = 85 # width bodies are wrapped to when rendered
+WRAP_WHITESPACE = '\t\n\x0b\x0c\r' # whitespace textwrap replaces with spaces
+
+_rendered = {} # rendered bodies by render key, see format_body()
+
+# processes that can sit between pacman and informant
+WRAPPER_NAMES = ('sudo', 'doas', 'su', 'fakeroot', 'env', 'sh', 'bash', 'dash', 'zsh')
 
 def err_print(*args, **kwargs):
     """ Same as builtin print but output to stderr with red color and "ERROR"
@@ -43,7 +52,10 @@ def debug_print(*args, **kwargs):
     option is provided.
     """
     if InformantConfig().get_argv_debug():
-        print(*args, file=sys.stderr, **kwargs)
+        # one write per line, so lines printed by parallel fetches don't run
+        # together the way print's separate write of 'end' lets them
+        end = kwargs.pop('end', '\n')
+        print(kwargs.pop('sep', ' ').join(str(arg) for arg in args) + end, end='', file=sys.stderr, **kwargs)
 
 def pacman_msg(*args, **kwargs):
     """ Same as print but include yellow color and "informant" preamble so the
@@ -73,12 +85,36 @@ def prompt_yes_no(question, default):
         return default
     return response
 
+def get_process_name(pid):
+    """ Return the name of the process 'pid' """
+    with open('/proc/{:d}/comm'.format(pid)) as comm:
+        return comm.read().strip()
+
+def get_parent_pid(pid):
+    """ Return the parent process id of the process 'pid' """
+    with open('/proc/{:d}/stat'.format(pid)) as stat:
+        # the process name can contain spaces so split after it, the parent
+        # pid is the second field following it
+        return int(stat.read().rsplit(')', 1)[1].split()[1])
+
+@functools.lru_cache(maxsize=None)
 def running_from_pacman():
-    """ Return True if the parent process is pacman """
-    ppid = os.getppid()
-    p_name = psutil.Process(ppid).name()
-    debug_print('informant running from: {}'.format(p_name))
-    return p_name == 'pacman'
+    """ Return True if the parent process is pacman, or if pacman started
+    informant through one of the WRAPPER_NAMES processes (e.g. `sudo pacman`
+    from an AUR helper). This is only checked once per run. """
+    pid = os.getppid()
+    try:
+        while pid > 1:
+            p_name = get_process_name(pid)
+            debug_print('informant running from: {}'.format(p_name))
+            if p_name == 'pacman':
+                return True
+            if p_name not in WRAPPER_NAMES:
+                return False
+            pid = get_parent_pid(pid)
+    except (OSError, ValueError, IndexError) as e:
+        debug_print('unable to find parent process: {}'.format(e))
+    return False
 
 def format_content(entry, body, timestamp, title) -> str:
     if entry.feed_name is not None:
@@ -89,11 +125,38 @@ def format_content(entry, body, timestamp, title) -> str:
     return content
 
 def format_body(body) :
-    h2t = html2text.HTML2Text()
-    h2t.inline_links = False
-    h2t.body_width = 85
-    body = h2t.handle(body)
-    return body
+    """ Return the HTML 'body' converted to text. Converted bodies are cached
+    in memory for this run and in the cache directory for later ones. """
+    import informant.file as fs
+    key = hashlib.sha1('{:d}|{}'.format(BODY_WIDTH, body).encode('utf-8')).hexdigest()
+    rendered = _rendered.get(key)
+    if rendered is None and InformantConfig().get_argv_use_cache():
+        rendered = fs.read_render_cache(key)
+    if rendered is not None:
+        trace.count('render_cache.hits')
+        _rendered[key] = rendered
+        return rendered
+
+    trace.count('render_cache.misses')
+    with trace.span('html2text'):
+        import html2text
+        # a HTML2Text instance keeps state (e.g. link numbers) between calls
+        # so it can't be reused without changing the output
+        h2t = html2text.HTML2Text()
+        h2t.inline_links = False
+        h2t.body_width = BODY_WIDTH
+        rendered = h2t.handle(body)
+    _rendered[key] = rendered
+    if InformantConfig().get_argv_use_cache():
+        fs.save_render_cache(key, rendered)
+    return rendered
+
+def prefetch_item(entry):
+    """ Start rendering the body of 'entry' in the background, so that it is
+    already cached when it is printed. """
+    if InformantConfig().get_argv().get(RAW_OPT):
+        return
+    threading.Thread(target=format_body, args=(entry.body,), daemon=True).start()
 
 def pretty_print_item(entry):
     """ Print out the given entry, replacing some markup to make it look nicer.
@@ -107,32 +170,39 @@ def pretty_print_item(entry):
     pager_is_valid = isinstance(pager, str) and shutil.which(pager) is not None
     bold = InformantConfig().colors['BOLD']
     clear = InformantConfig().colors['CLEAR']
-    if not argv.get(RAW_OPT):
-        body = format_body(body)              
-        if pager_is_valid:
-            # format the title as a markdown header
-            # for a pager.
-            title = f"# {title}"
-        else:
-            #if not using raw also bold title
-            title = bold + title + clear         
-    
+    with trace.span('render'):
+        if not argv.get(RAW_OPT):
+            body = format_body(body)
+            if pager_is_valid:
+                # format the title as a markdown header
+                # for a pager.
+                title = f"# {title}"
+            else:
+                #if not using raw also bold title
+                title = bold + title + clear
+        content = format_content(entry, body, timestamp, title)
+
     if pager_is_valid:
         with os.popen(pager, 'w') as pipe:
-            pipe.write(format_content(entry, body, timestamp, title))
+            pipe.write(content)
     else:
-        print(format_content(entry, body, timestamp, title))
+        print(content)
 
-def format_list_item(entry, index):
+def format_list_item(entry, index, terminal_width=None):
     """ Returns a formatted string with the entry's index number, title, and
     right-aligned timestamp. Unread items are bolded"""
     bold = InformantConfig().colors['BOLD']
     clear = InformantConfig().colors['CLEAR']
-    terminal_width = shutil.get_terminal_size().columns
+    if terminal_width is None:
+        terminal_width = shutil.get_terminal_size().columns
     timestamp = str(entry.pretty_date)
     wrap_width = terminal_width - len(timestamp) - 1
     heading = str(index) + ': ' + entry.title
-    wrapped_heading = textwrap.wrap(heading, wrap_width)
+    if len(heading) <= wrap_width and heading == heading.rstrip() and not any(char in heading for char in WRAP_WHITESPACE):
+        # textwrap would return it unchanged
+        wrapped_heading = [heading]
+    else:
+        wrapped_heading = textwrap.wrap(heading, wrap_width)
     padding = terminal_width - len(wrapped_heading[0] + timestamp)
     if entry.has_been_read():
         return (
@@ -153,3 +223,37 @@ def format_list_item(entry, index):
             clear
         )
 
+def format_list(entries):
+    """ Yield the formatted list item (see format_list_item) of each of
+    'entries', numbered from 0, looking up the terminal size only once. """
+    terminal_width = shutil.get_terminal_size().columns
+    for index, entry in enumerate(entries):
+        yield format_list_item(entry, index, terminal_width)
+
+def print_lines(lines, count):
+    """ Print the 'count' strings from the iterable 'lines'. If a pager is set,
+    stdout is a terminal and they don't fit on it they are streamed into the
+    pager as they are formatted, otherwise they are written in one chunk. """
+    pager = InformantConfig().get_pager()
+    if (isinstance(pager, str) and shutil.which(pager) is not None and sys.stdout.isatty()
+            and count >= shutil.get_terminal_size().lines):
+        env = dict(os.environ)
+        # like git: quit if it fits after all, keep colors and the screen
+        env.setdefault('LESS', 'FRX')
+        pipe = subprocess.Popen(pager, shell=True, stdin=subprocess.PIPE, env=env, universal_newlines=True)
+        try:
+            for line in lines:
+                pipe.stdin.write(line + '\n')
+            pipe.stdin.close()
+        except BrokenPipeError:
+            # the pager was quit before the end of the list
+            try:
+                pipe.stdin.close()
+            except BrokenPipeError:
+                pass
+        pipe.wait()
+        return
+    with trace.span('render'):
+        output = ''.join(line + '\n' for line in lines)
+    sys.stdout.write(output)
+    sys.stdout.flush()
@@ -0,0 +1,80 @@
+"""
+tests/test_timestamp.py
+
+Checks that informant/timestamp.py parses dates the same way dateutil does,
+whichever of its parsers ends up handling them.
+"""
+
+import unittest
+
+from dateutil import parser as date_parser
+
+from informant.timestamp import TimestampParser
+
+DATES = (
+    # formats with a fast parser
+    'Sun, 01 Sep 2024 10:00:00 GMT',
+    'Sun, 01 Sep 2024 10:00:00 +0000',
+    'Sun, 01 Sep 2024 12:00:00 +0200',
+    'sun, 01 sep 2024 10:00 UTC',
+    '1 Sep 2024 10:00 UTC',
+    '2024-09-01T10:00:00Z',
+    '2024-09-01T10:00:00+00:00',
+    '2024-09-01T12:00:00.25+02:00',
+    '2024-09-01 10:00:00Z',
+    '2024-09-01T10:00Z',
+    # formats feedparser gets wrong or accepts where dateutil doesn't
+    '2024-09-01 10:00:00 UTC',
+    '2024-09-01 10:00 GMT',
+    '20240901T100000Z',
+    '2024-W35-7T10:00:00Z',
+    'Sun, 1 Sep 2024 10:00:00 UT Z',
+    '2024-09-01T24:00:00Z',
+    '2024-02-31T10:00:00Z',
+    '2024-09-01T10:60:00Z',
+    # invalid in ways the fast parsers must not accept
+    'Xyz, 01 Sep 2024 10:00:00 GMT',
+    'Sun, 01 Sep 0070 10:00:00 GMT',
+    'Sun, 31 Feb 2024 10:00:00 GMT',
+)
+
+def parse_dateutil(text):
+    """ Return what dateutil makes of 'text', None if it rejects it """
+    try:
+        return date_parser.parse(text)
+    except (ValueError, OverflowError):
+        return None
+
+def parse_informant(parser, text):
+    """ Return what 'parser' makes of 'text', None if it rejects it """
+    try:
+        return parser.parse(text)
+    except (ValueError, OverflowError):
+        return None
+
+class TimestampParserTest(unittest.TestCase):
+
+    def assertSameDate(self, text, timestamp, expected):
+        if expected is None:
+            self.assertIsNone(timestamp, text)
+            return
+        self.assertIsNotNone(timestamp, text)
+        # compare the wall time and offset, not only the instant
+        self.assertEqual(timestamp.replace(tzinfo=None), expected.replace(tzinfo=None), text)
+        self.assertEqual(timestamp.utcoffset(), expected.utcoffset(), text)
+
+    def test_matches_dateutil(self):
+        for text in DATES:
+            with self.subTest(text=text):
+                self.assertSameDate(text, parse_informant(TimestampParser(), text),
+                                    parse_dateutil(text))
+
+    def test_learned_parser_matches_dateutil(self):
+        # one parser for the whole list, as for the items of one feed
+        parser = TimestampParser()
+        for text in DATES:
+            with self.subTest(text=text):
+                self.assertSameDate(text, parse_informant(parser, text), parse_dateutil(text))
+
+if __name__ == '__main__':
+    unittest.main()